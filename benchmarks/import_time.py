@@ -0,0 +1,72 @@
+"""
+Import-time benchmark of the CLI.
+
+Runs light subcommands in fresh interpreters and checks that they start quickly
+and without importing the heavy libraries only `classify` and the plots need.
+
+    python benchmarks/import_time.py [--repeat 5] [--max-seconds 1.0]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["torch", "transformers", "seaborn", "matplotlib"]
+
+# Parses the CLI like `main.py <command> --help` would, then reports which heavy
+# modules got imported along the way.
+PROBE = """
+import io
+import sys
+import contextlib
+import main
+parser = main.build_parser()
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        parser.parse_args([{command!r}, "--help"])
+    except SystemExit:
+        pass
+import src.model.parse_output, src.analysis.predictions_analysis
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def time_command(command, repeat):
+    timings = []
+    loaded = ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE.format(command=command, heavy=HEAVY_MODULES)],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        )
+        timings.append(time.perf_counter() - start)
+        loaded = result.stdout.strip()
+    return timings, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CLI start-up time.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=1.0,
+                        help="Fail when the median start-up time exceeds this")
+    args = parser.parse_args()
+
+    failed = False
+    for command in ["parse", "prediction-analysis"]:
+        timings, loaded = time_command(command, args.repeat)
+        median = statistics.median(timings)
+        print(f"{command:<20} median {median:.3f}s  min {min(timings):.3f}s  heavy modules: {loaded or '-'}")
+
+        if median > args.max_seconds or loaded:
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Benchmark of the pipeline stages on synthetic corpora.
+
+For each scale, a synthetic corpus (see synthetic.py) is written to the work
+directory, then each stage runs in a fresh interpreter on the outputs of the
+previous one, with the random backend in place of Minerva. Every stage reports wall
+time (of the stage itself, imports excluded), peak RSS of its process and rows/s.
+
+    python benchmarks/pipeline.py --scales 10 100 [--stages parse prediction-analysis]
+                                  [--runs 3] [--workdir /tmp/oster-bench] [--output results.jsonl]
+
+Stages, in order:
+    filter               load the corpus and compute the 5-cluster view (data_on5.csv)
+    prompts              build the prompts of every run
+    classify             classify with the random backend (classifications_<i>.csv)
+    parse                parse every run (parsed_output_<i>.csv)
+    corpus-analysis      CorpusAnalysis.generate_full_report
+    prediction-analysis  PredictionsAnalysis.generate_full_report
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import importlib
+import contextlib
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STAGES = ["filter", "prompts", "classify", "parse", "corpus-analysis", "prediction-analysis"]
+SEEDS = [42, 43, 44, 45, 46, 47, 48, 49, 50]
+
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS).
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+
+class Paths:
+    """Files of one benchmark directory, laid out like the repository."""
+
+    def __init__(self, directory, n_runs):
+        self.directory = directory
+        self.n_runs = n_runs
+        self.corpus = f"{directory}/corpus.csv"
+        self.preprocessed = f"{directory}/preprocessed"
+        self.on5 = f"{self.preprocessed}/data_on5.csv"
+        self.predictions = f"{directory}/predictions"
+        self.parsed = f"{directory}/parsed_output"
+        self.analysis = f"{directory}/analysis_output"
+        self.run_numbers = list(range(1, n_runs + 1))
+
+    def classification(self, i):
+        return f"{self.predictions}/classifications_{i}.csv"
+
+    def parsed_output(self, i):
+        return f"{self.parsed}/parsed_output_{i}.csv"
+
+    def make_dirs(self):
+        for path in (self.preprocessed, self.predictions, self.parsed, self.analysis):
+            os.makedirs(path, exist_ok=True)
+
+
+
+# Each stage reads its inputs, runs, and returns the number of rows it processed.
+
+def stage_filter(paths):
+    from src.data.loader import load_corpus
+    from src.data.preprocessing import cluster_based_filter
+
+    # Measure a cold run, not the cached view of a previous one.
+    if os.path.exists(paths.preprocessed):
+        shutil.rmtree(paths.preprocessed)
+    os.makedirs(paths.preprocessed)
+
+    df = load_corpus(paths.corpus)
+    cluster_based_filter(df, output_dir=paths.preprocessed)
+    return len(df)
+
+
+def stage_prompts(paths):
+    import pandas as pd
+    from src.model.classification import build_prompts, prepare_dataset
+
+    dataset = prepare_dataset(pd.read_csv(paths.on5))
+    for seed in SEEDS[:paths.n_runs]:
+        build_prompts(dataset, seed)
+    return len(dataset) * paths.n_runs
+
+
+def stage_classify(paths):
+    import pandas as pd
+    from src.model.classification import RandomBackend, classify
+
+    classify(
+        df=pd.read_csv(paths.on5),
+        pred_path=paths.predictions,
+        processed_fileame=[f"processed_dataset_{i}" for i in paths.run_numbers],
+        prediction_filename=[f"classifications_{i}" for i in paths.run_numbers],
+        seed=SEEDS[:paths.n_runs],
+        backend=RandomBackend()
+    )
+    return sum(count_rows(paths.classification(i)) for i in paths.run_numbers)
+
+
+def stage_parse(paths):
+    from src.model.parse_output import parse_single_file
+
+    for i in paths.run_numbers:
+        parse_single_file(paths.classification(i), paths.parsed_output(i))
+    return sum(count_rows(paths.classification(i)) for i in paths.run_numbers)
+
+
+def stage_corpus_analysis(paths):
+    from src.data.loader import load_corpus
+    from src.analysis.corpus_analysis import CorpusAnalysis
+
+    df = load_corpus(paths.corpus)
+    CorpusAnalysis(df=df, output_dir=paths.analysis).generate_full_report()
+    return len(df)
+
+
+def stage_prediction_analysis(paths):
+    from src.analysis.predictions_analysis import PredictionsAnalysis
+
+    data_paths = {'input_file': paths.on5, 'original_dataset': paths.corpus}
+    for i in paths.run_numbers:
+        data_paths[f'run_{i}'] = paths.parsed_output(i)
+        data_paths[f'classification_{i}'] = paths.classification(i)
+
+    PredictionsAnalysis(output_dir=paths.analysis, data_paths=data_paths, n_runs=paths.n_runs).generate_full_report()
+    return sum(count_rows(paths.parsed_output(i)) for i in paths.run_numbers)
+
+
+STAGE_FUNCTIONS = {
+    "filter": stage_filter,
+    "prompts": stage_prompts,
+    "classify": stage_classify,
+    "parse": stage_parse,
+    "corpus-analysis": stage_corpus_analysis,
+    "prediction-analysis": stage_prediction_analysis,
+}
+
+
+
+def count_rows(csv_path):
+    import pandas as pd
+    return len(pd.read_csv(csv_path, usecols=[0]))
+
+
+
+def run_stage(stage, directory, n_runs, verbose=False):
+    """Runs one stage in this process and returns its measurements."""
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    paths = Paths(directory, n_runs)
+    paths.make_dirs()
+
+    # Import the libraries the stage uses before starting the clock.
+    for module in ("pandas", "numpy"):
+        importlib.import_module(module)
+    if stage in ("prompts", "classify"):
+        importlib.import_module("src.model.classification")
+
+    rss_before = peak_rss_mb()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        start = time.perf_counter()
+        rows = STAGE_FUNCTIONS[stage](paths)
+        seconds = time.perf_counter() - start
+
+    return {"stage": stage, "rows": rows, "seconds": round(seconds, 3),
+            "rows_per_second": round(rows / seconds, 1) if seconds else None,
+            "rss_before_mb": round(rss_before, 1), "peak_rss_mb": round(peak_rss_mb(), 1)}
+
+
+
+def benchmark_stage(stage, directory, n_runs, verbose=False):
+    """Runs one stage in a fresh interpreter, so that its peak RSS is its own."""
+    command = [sys.executable, os.path.abspath(__file__), "--run-stage", stage,
+               "--workdir", directory, "--runs", str(n_runs)]
+    if verbose:
+        command.append("--verbose")
+    result = subprocess.run(command, cwd=ROOT, stdout=subprocess.PIPE,
+                            stderr=None if verbose else subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr or "")
+        raise RuntimeError(f"Stage {stage} failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+
+def stage_outputs_exist(stage, paths):
+    outputs = {
+        "filter": [paths.on5],
+        "classify": [paths.classification(i) for i in paths.run_numbers],
+        "parse": [paths.parsed_output(i) for i in paths.run_numbers],
+    }.get(stage)
+    # Stages without outputs needed later can always be skipped.
+    return outputs is None or all(os.path.exists(path) for path in outputs)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic corpora.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10],
+                        help="Sizes of the synthetic corpora, in copies of the real one")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES,
+                        help="Stages to measure (their inputs are produced by the earlier stages when missing)")
+    parser.add_argument("--runs", type=int, default=3, help="Number of seeded runs classified and analysed")
+    parser.add_argument("--workdir", default="/tmp/oster-bench")
+    parser.add_argument("--output", default=None, help="Append the results to this file as JSON lines")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the stages")
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        print(json.dumps(run_stage(args.run_stage, args.workdir, args.runs, args.verbose)))
+        return
+
+    from benchmarks.synthetic import synthetic_corpus
+
+    if args.runs > len(SEEDS):
+        parser.error(f"at most {len(SEEDS)} runs")
+
+    print(f"{'scale':>6} {'stage':<20} {'rows':>10} {'seconds':>9} {'rows/s':>11} {'peak RSS MB':>12}")
+    for scale in args.scales:
+        directory = f"{args.workdir}/x{scale}"
+        paths = Paths(directory, args.runs)
+        paths.make_dirs()
+        if not os.path.exists(paths.corpus):
+            synthetic_corpus(scale).to_csv(paths.corpus, index=False)
+
+        # Stages not measured still run when a measured one needs their outputs.
+        last = max(STAGES.index(stage) for stage in args.stages)
+        for stage in STAGES[:last + 1]:
+            if stage not in args.stages and stage_outputs_exist(stage, paths):
+                continue
+            result = {"scale": scale, **benchmark_stage(stage, directory, args.runs, args.verbose)}
+            if stage not in args.stages:
+                continue
+
+            print(f"{scale:>6} {stage:<20} {result['rows']:>10} {result['seconds']:>9.3f} "
+                  f"{result['rows_per_second'] or 0:>11.1f} {result['peak_rss_mb']:>12.1f}")
+            if args.output:
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Synthetic inputs for the benchmarks.
+
+`synthetic_corpus` scales the O-Ster corpus up by replicating it with new ids,
+tagged tweets (so that prompts stay distinct and are not deduplicated) and part
+of the cluster labels redrawn, keeping the schema of open_stereotypes_corpus.csv.
+Prediction files with the schema of classifications_*.csv are then produced in
+seconds by `classify` with the deterministic `RandomBackend` in place of Minerva.
+
+    python benchmarks/synthetic.py --scale 100 --output /tmp/corpus_x100.csv
+"""
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.data.filters import ANNOTATORS, LEVELS, cluster_column
+from src.data.loader import CORPUS_PATH
+
+
+# Columns holding the text of the tweet; replicas get a tag appended to them.
+TEXT_COLUMNS = ["tweet", "text", "text_original"]
+
+
+
+def annotator_columns(annotator):
+    """Cluster columns of one annotator (names and numbers, all levels), redrawn together."""
+    return [cluster_column(level, annotator, named) for level in LEVELS for named in (True, False)]
+
+
+
+def synthetic_corpus(scale, seed=0, label_noise=0.2, source=os.path.join(ROOT, CORPUS_PATH)):
+    """
+    Replicates the corpus `scale` times. Replica 0 is the corpus itself; in the
+    others, ids get a `_r<k>` suffix, tweets a ` #r<k>` tag, and for a
+    `label_noise` share of the rows each annotator's cluster labels are copied
+    from another random row (all levels together, so they stay consistent).
+
+    Returns:
+    --------
+    df: pandas.DataFrame
+        - same columns and dtypes as the corpus, `scale` times the rows
+    """
+    corpus = pd.read_csv(source)
+    rng = np.random.default_rng(seed)
+    replicas = [corpus]
+
+    for k in range(1, scale):
+        replica = corpus.copy()
+        replica["id"] = replica["id"] + f"_r{k}"
+        for col in TEXT_COLUMNS:
+            replica[col] = replica[col] + f" #r{k}"
+
+        for annotator in ANNOTATORS:
+            # Not every annotator has the cluster number columns.
+            cols = [col for col in annotator_columns(annotator) if col in corpus.columns]
+            redraw = np.flatnonzero(rng.random(len(replica)) < label_noise)
+            donors = rng.integers(0, len(corpus), size=len(redraw))
+            for col in cols:
+                values = replica[col].to_numpy(copy=True)
+                values[redraw] = corpus[col].to_numpy()[donors]
+                replica[col] = values
+
+        replicas.append(replica)
+
+    return pd.concat(replicas, ignore_index=True)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic O-Ster corpus.")
+    parser.add_argument("--scale", type=int, default=10, help="Number of copies of the corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label-noise", type=float, default=0.2,
+                        help="Share of rows whose cluster labels are redrawn in each copy")
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    df = synthetic_corpus(args.scale, seed=args.seed, label_noise=args.label_noise)
+    df.to_csv(args.output, index=False)
+    print(f"Wrote {len(df)} rows to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,66 +1,346 @@
-import pandas as pd 
 import argparse
-from src.data.preprocessing import cluster_based_filter
-from src.model.classification import classify
-from src.model.parse_output import parse_single_file
-from src.analysis.corpus_analysis import CorpusAnalysis
-from src.analysis.predictions_analysis import PredictionsAnalysis
 
-def main():
-    parser = argparse.ArgumentParser(description="Run O-Ster pipeline.")
+# Heavy dependencies (torch, transformers, seaborn, matplotlib) and the corpus are
+# only loaded by the subcommands that need them, inside their handlers.
+
+CORPUS_PATH = "O-Ster dataset/original_dataset/open_stereotypes_corpus.csv"
+
+
+def load_filtered_corpus():
+    from src.data.loader import load_corpus
+    from src.data.preprocessing import cluster_based_filter
+    from src.instrumentation import stage
+
+    with stage("load_corpus") as metrics:
+        df = load_corpus(CORPUS_PATH)
+        metrics["rows"] = len(df)
+    with stage("filter") as metrics:
+        df_on5 = cluster_based_filter(df)
+        # Throughput is over the rows read; the rows kept are recorded separately.
+        metrics["rows"] = len(df)
+        metrics["output_rows"] = len(df_on5)
+    print("\n\n")
+    return df_on5
+
+
+def run_names(seeds):
+    processed_names = [f"processed_dataset_{i}" for i in range(1, len(seeds) + 1)]
+    prediction_names = [f"classifications_{i}" for i in range(1, len(seeds) + 1)]
+    return processed_names, prediction_names
+
+
+def build_backend(args):
+    if args.backend == "hf":
+        # classify builds the default Hugging Face backend itself.
+        return None
+
+    from src.model.classification import RandomBackend, ReplayBackend
+    if args.backend == "random":
+        return RandomBackend(seed=args.seeds[0])
+    if not args.replay_files:
+        raise SystemExit("--backend replay needs --replay-files")
+    return ReplayBackend(args.replay_files)
+
+
+def run_classify(args):
+    processed_names, prediction_names = run_names(args.seeds)
+    classify_kwargs = dict(
+        backend=build_backend(args),
+        model_id=args.model_id,
+        precision=args.precision,
+        seed=args.seeds,
+        batch_size=args.batch_size,
+        resume=args.resume,
+        mode=args.mode,
+        use_prefix_cache=not args.no_prefix_cache,
+        stop_on_answer=not args.no_early_stop,
+        cache_path=args.cache,
+        cache_max_bytes=int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None
+    )
+
+    df_on5 = load_filtered_corpus()
+
+    print("Running classification...")
+    if args.shards == 1:
+        from src.model.classification import classify
+        classify(
+            df=df_on5,
+            pred_path="./predictions",
+            processed_fileame=processed_names,
+            prediction_filename=prediction_names,
+            **classify_kwargs
+        )
+    elif args.shard_index is not None:
+        from src.model.sharding import classify_shard
+        classify_shard(
+            df=df_on5,
+            pred_path="./predictions",
+            processed_fileame=processed_names,
+            prediction_filename=prediction_names,
+            n_shards=args.shards,
+            shard_index=args.shard_index,
+            **classify_kwargs
+        )
+    else:
+        from src.model.sharding import classify_sharded
+        classify_sharded(
+            df=df_on5,
+            pred_path="./predictions",
+            processed_fileame=processed_names,
+            prediction_filename=prediction_names,
+            n_shards=args.shards,
+            workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            **classify_kwargs
+        )
+
+
+def run_quantize(args):
+    from src.model.classification import save_quantized
+
+    print(f"Quantizing {args.model_id} to int8...")
+    save_quantized(args.model_id, args.output)
+    print(f"Saved to {args.output}; pass it as --model-id to classify")
+
+
+def run_check_precision(args):
+    from src.model.precision_check import check_precision
+
+    n_runs = range(1, len(args.seeds) + 1)
+    check_precision(
+        df=load_filtered_corpus(),
+        reference_files=args.references or [f"./parsed_output/parsed_output_{i}.csv" for i in n_runs],
+        reference_classifications=args.reference_classifications or [f"./predictions/classifications_{i}.csv" for i in n_runs],
+        output_dir=args.output_dir,
+        seeds=args.seeds,
+        precision=args.precision,
+        reference_precision=args.reference_precision,
+        model_id=args.model_id,
+        sample=args.sample or None,
+        batch_size=args.batch_size,
+        mode=args.mode
+    )
+
+
+def run_merge_shards(args):
+    from src.model.sharding import merge_shards
+
+    print("Merging classification shards...")
+    processed_names, prediction_names = run_names(args.seeds)
+    merge_shards("./predictions", processed_names, prediction_names, args.shards)
+
+
+def run_parse(args):
+    from src.model.parse_output import parse_single_file
 
+    print("Parsing classification output...")
+    parse_single_file(
+        input_file=f"./predictions/classifications_{args.run}.csv",
+        output_file=f"./parsed_output/parsed_output_{args.run}.csv",
+        chunksize=args.chunksize
+    )
+
+
+def run_corpus_analysis(args):
+    from src.data.loader import load_corpus
+    from src.analysis.corpus_analysis import CorpusAnalysis
+
+    print("Running corpus analysis...")
+    df = load_corpus(CORPUS_PATH)
+    corpus_analyzer = CorpusAnalysis(df=df, output_dir="./analysis_output")
+    corpus_analyzer.generate_full_report()
+    print("Corpus analysis completed.")
+
+
+def run_prediction_analysis(args):
+    from src.analysis.predictions_analysis import PredictionsAnalysis
+
+    print("Running prediction analysis...")
+    prediction_analyzer = PredictionsAnalysis(output_dir="./analysis_output", n_runs=args.runs)
+    prediction_analyzer.generate_full_report()
+    print("Prediction analysis completed.")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Run O-Ster pipeline.")
     parser.add_argument(
-        "--classify", action="store_true",
-        help="Run classification on the filtered dataset"
+        "--metrics-file", default=None,
+        help="Append per-stage timing, throughput and memory records (and per-batch generation records) to this file as JSON lines"
     )
     parser.add_argument(
-        "--parse", action="store_true",
-        help="Parse the classification output file"
+        "--profile", choices=["cprofile", "tracemalloc"], default=None,
+        help="Profile the command, printing the top functions (cprofile) or allocation sites (tracemalloc) to stderr"
     )
     parser.add_argument(
-        "--corpus-analysis", action="store_true",
+        "--profile-output", default=None,
+        help="Also save the cProfile statistics or the tracemalloc snapshot to this file"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Options shared by the commands that deal with seeded runs and shards.
+    runs = argparse.ArgumentParser(add_help=False)
+    runs.add_argument(
+        "--seeds", type=int, nargs="+", default=[42],
+        help="One seed per run; run i is written to classifications_i.csv. All runs share one model load"
+    )
+    runs.add_argument(
+        "--shards", type=int, default=1,
+        help="Split the dataset by id hash into this many shards"
+    )
+
+    # Options shared by the commands that load the model.
+    model = argparse.ArgumentParser(add_help=False)
+    model.add_argument(
+        "--model-id", default="sapienzanlp/Minerva-7B-instruct-v1.0",
+        help="Hugging Face model id or local directory (e.g. one written by the quantize command)"
+    )
+    model.add_argument(
+        "--precision", choices=["bf16", "fp32", "int8"], default="bf16",
+        help="Weights precision; int8 dynamically quantizes the linear layers and runs on CPU"
+    )
+
+    classify_parser = subparsers.add_parser(
+        "classify", parents=[runs, model],
+        help="Run classification on the filtered dataset"
+    )
+    classify_parser.add_argument(
+        "--backend", choices=["hf", "replay", "random"], default="hf",
+        help="Where outputs come from: the Hugging Face model, existing classification files (--replay-files), "
+             "or a deterministic random choice among the options (no model, for fast offline runs)"
+    )
+    classify_parser.add_argument(
+        "--replay-files", nargs="+", default=None,
+        help="Classification files replayed by --backend replay (read before the outputs are written, "
+             "so they can be the files being regenerated)"
+    )
+    classify_parser.add_argument(
+        "--batch-size", type=int, default=8,
+        help="Number of prompts generated together during classification"
+    )
+    classify_parser.add_argument(
+        "--mode", choices=["generate", "score"], default="generate",
+        help="Generate free text and parse it, or score the three options and pick the most likely one"
+    )
+    classify_parser.add_argument(
+        "--no-prefix-cache", action="store_true",
+        help="Encode the shared instruction block for every row instead of reusing its key/value cache"
+    )
+    classify_parser.add_argument(
+        "--no-early-stop", action="store_true",
+        help="Always generate the maximum number of tokens instead of stopping each row once it has produced an option or closed the answer list"
+    )
+    classify_parser.add_argument(
+        "--shard-index", type=int, default=None,
+        help="Only classify this shard (e.g. one shard per machine); combine them later with merge-shards"
+    )
+    classify_parser.add_argument(
+        "--workers", type=int, default=None,
+        help="Worker processes used when all shards are classified on this machine (default: one per shard)"
+    )
+    classify_parser.add_argument(
+        "--threads-per-worker", type=int, default=None,
+        help="Torch threads pinned in each worker process (default: cores divided by workers)"
+    )
+    classify_parser.add_argument(
+        "--cache", default=None,
+        help="SQLite file caching model outputs by (model, prompt, seed, generation parameters)"
+    )
+    classify_parser.add_argument(
+        "--cache-max-mb", type=float, default=None,
+        help="Evict the least recently used cached outputs beyond this size"
+    )
+    classify_parser.add_argument(
+        "--resume", action="store_true",
+        help="Resume an interrupted classification, skipping rows already classified"
+    )
+    classify_parser.set_defaults(func=run_classify)
+
+    quantize_parser = subparsers.add_parser(
+        "quantize",
+        help="Quantize the model to int8 once and save it to a local directory"
+    )
+    quantize_parser.add_argument("--model-id", default="sapienzanlp/Minerva-7B-instruct-v1.0")
+    quantize_parser.add_argument("--output", required=True, help="Directory of the quantized model")
+    quantize_parser.set_defaults(func=run_quantize)
+
+    check_parser = subparsers.add_parser(
+        "check-precision", parents=[model],
+        help="Classify the prompts of existing runs with a given precision and compare the parsed labels with theirs"
+    )
+    check_parser.add_argument(
+        "--seeds", type=int, nargs="+", default=[42],
+        help="Seeds of the reference runs, one per reference file"
+    )
+    check_parser.add_argument(
+        "--references", nargs="+", default=None,
+        help="Parsed outputs to compare with (default: parsed_output/parsed_output_<i>.csv for each seed)"
+    )
+    check_parser.add_argument(
+        "--reference-classifications", nargs="+", default=None,
+        help="Classification files whose prompts are reused (default: predictions/classifications_<i>.csv for each seed)"
+    )
+    check_parser.add_argument(
+        "--reference-precision", choices=["bf16", "fp32", "int8"], default=None,
+        help="Also classify the same prompts with this precision and compare with it (a second model run)"
+    )
+    check_parser.add_argument(
+        "--sample", type=int, default=200,
+        help="Number of tweets classified for the check (0 for all)"
+    )
+    check_parser.add_argument("--batch-size", type=int, default=8)
+    check_parser.add_argument("--mode", choices=["generate", "score"], default="generate")
+    check_parser.add_argument(
+        "--output-dir", default="./precision_check",
+        help="Where the classification and parsed files of the check are written"
+    )
+    check_parser.set_defaults(func=run_check_precision, precision="int8")
+
+    merge_parser = subparsers.add_parser(
+        "merge-shards", parents=[runs],
+        help="Merge the shard files of a sharded classification into the usual prediction files"
+    )
+    merge_parser.set_defaults(func=run_merge_shards)
+
+    parse_parser = subparsers.add_parser(
+        "parse",
+        help="Parse the classification output file"
+    )
+    parse_parser.add_argument(
+        "--run", type=int, default=1,
+        help="Parse predictions/classifications_<run>.csv into parsed_output/parsed_output_<run>.csv"
+    )
+    parse_parser.add_argument(
+        "--chunksize", type=int, default=None,
+        help="Parse the classification file this many rows at a time (bounded memory)"
+    )
+    parse_parser.set_defaults(func=run_parse)
+
+    corpus_parser = subparsers.add_parser(
+        "corpus-analysis",
         help="Run analysis on the original corpus"
     )
-    parser.add_argument(
-        "--prediction-analysis", action="store_true",
+    corpus_parser.set_defaults(func=run_corpus_analysis)
+
+    prediction_parser = subparsers.add_parser(
+        "prediction-analysis",
         help="Run analysis on the predictions"
     )
+    prediction_parser.add_argument(
+        "--runs", type=int, default=3,
+        help="Number of runs to compare (parsed_output_1..N and classifications_1..N)"
+    )
+    prediction_parser.set_defaults(func=run_prediction_analysis)
 
-    args = parser.parse_args()
-
-    # Load dataset
-    df = pd.read_csv("O-Ster dataset/original_dataset/open_stereotypes_corpus.csv", sep=",")
-    df_on5 = cluster_based_filter(df)
-    print("\n\n")
-    
-    if args.classify:
-        print("Running classification...")
-        classify(
-            df=df_on5,
-            pred_path="./predictions",
-            processed_fileame="processed_dataset_1",
-            prediction_filename="classifications_1",
-            seed=42
-        )
+    return parser
 
-    if args.parse:
-        print("Parsing classification output...")
-        parse_single_file(
-            input_file="./predictions/classifications_1.csv",
-            output_file="./parsed_output/parsed_output_1.csv"
-        )
 
-    if args.corpus_analysis:
-        print("Running corpus analysis...")
-        corpus_analyzer = CorpusAnalysis(df=df, output_dir="./analysis_output")
-        corpus_analyzer.generate_full_report()
-        print("Corpus analysis completed.")
+def main(argv=None):
+    args = build_parser().parse_args(argv)
 
-    if args.prediction_analysis:
-        print("Running prediction analysis...")
-        prediction_analyzer = PredictionsAnalysis(output_dir="./analysis_output")
-        prediction_analyzer.generate_full_report()
-        print("Prediction analysis completed.")
+    from src.instrumentation import configure, profile, stage
+    configure(args.metrics_file)
+    with profile(args.profile, args.profile_output), stage("command", command=args.command):
+        args.func(args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,203 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+
+# Every metric is computed from a table that is a sum of per-item contributions
+# (a contingency table, category counts, a coincidence matrix). Bootstrap resamples
+# are then just weighted sums of the same contributions, computed for a whole block
+# of resamples with one matrix product instead of recomputing the metric per resample.
+
+
+
+def encode_labels(df, columns):
+    """
+    Encodes the labels of `columns` as integer codes over one shared, sorted list of
+    categories. Missing labels get code -1.
+
+    Returns:
+    --------
+    codes: np.ndarray
+        - items x columns matrix of codes
+    categories: list
+    """
+    values = df[list(columns)].astype(object).to_numpy()
+    codes, categories = pd.factorize(values.ravel(), sort=True)
+    return codes.reshape(values.shape), list(categories)
+
+
+
+def contingency_table(a, b, n_a, n_b=None):
+    """Counts of each (a, b) code pair, pairs with a missing code (-1) are skipped."""
+    n_b = n_a if n_b is None else n_b
+    valid = (a >= 0) & (b >= 0)
+    return np.bincount(a[valid] * n_b + b[valid], minlength=n_a * n_b).reshape(n_a, n_b)
+
+
+
+def item_counts(codes, n_categories):
+    """items x categories matrix with the number of coders giving each category to each item."""
+    n_items = codes.shape[0]
+    rows = np.repeat(np.arange(n_items), codes.shape[1])
+    flat = codes.ravel()
+    valid = flat >= 0
+    return np.bincount(rows[valid] * n_categories + flat[valid],
+                       minlength=n_items * n_categories).reshape(n_items, n_categories)
+
+
+
+# Per-item contributions
+
+def _cohen_contributions(a, b, n_categories):
+    contributions = np.zeros((len(a), n_categories * n_categories))
+    valid = (a >= 0) & (b >= 0)
+    contributions[np.flatnonzero(valid), a[valid] * n_categories + b[valid]] = 1
+    return contributions.reshape(len(a), n_categories, n_categories)
+
+
+def _fleiss_contributions(counts):
+    # Category counts, observed pairwise agreement P_i and 1 per item (to average
+    # P_i), for items rated at least twice.
+    m = counts.sum(axis=1)
+    rated = m >= 2
+    p_item = np.zeros(len(counts))
+    p_item[rated] = ((counts[rated] ** 2).sum(axis=1) - m[rated]) / (m[rated] * (m[rated] - 1))
+    return np.column_stack([counts * rated[:, None], p_item, rated]).astype(float)
+
+
+def _alpha_contributions(counts):
+    # Coincidence matrix of each item: every ordered pair of values from different
+    # coders, weighted by 1 / (m_u - 1). Items with a single value are not pairable.
+    m = counts.sum(axis=1)
+    weight = np.where(m >= 2, 1 / np.maximum(m - 1, 1), 0)[:, None, None]
+    pairs = counts[:, :, None] * counts[:, None, :] - counts[:, :, None] * np.eye(counts.shape[1])
+    return pairs * weight
+
+
+
+# Statistics of the summed tables (batched over leading axes)
+
+def _cohen_statistic(table):
+    n = table.sum(axis=(-2, -1))
+    observed = np.trace(table, axis1=-2, axis2=-1) / n
+    expected = (table.sum(axis=-1) * table.sum(axis=-2)).sum(axis=-1) / n ** 2
+    return (observed - expected) / (1 - expected)
+
+
+def _fleiss_statistic(table):
+    counts, p_item, n_items = table[..., :-2], table[..., -2], table[..., -1]
+    p_category = counts / counts.sum(axis=-1, keepdims=True)
+    observed = p_item / n_items
+    expected = (p_category ** 2).sum(axis=-1)
+    return (observed - expected) / (1 - expected)
+
+
+def _alpha_statistic(table):
+    n_category = table.sum(axis=-1)
+    n = n_category.sum(axis=-1)
+    disagreement_observed = n - np.trace(table, axis1=-2, axis2=-1)
+    disagreement_expected = n ** 2 - (n_category ** 2).sum(axis=-1)
+    return 1 - (n - 1) * disagreement_observed / disagreement_expected
+
+
+
+def bootstrap(contributions, statistic, n_resamples=1000, confidence=0.95, seed=42, block_elements=2 ** 24):
+    """
+    Point estimate and percentile bootstrap interval of `statistic`, resampling items.
+
+    Each block of resamples is a matrix of item weights (how many times each item is
+    drawn, built with bincount) multiplied by the item contributions, so thousands of
+    resamples take a few matrix products.
+
+    Parameters:
+    -----------
+    contributions : np.ndarray
+        - per-item contributions (items x ...), summed over items into the table
+          `statistic` is computed from
+    statistic : callable
+        - metric of a table, vectorized over leading (resample) axes
+    n_resamples : int
+        - number of bootstrap resamples, 0 for the point estimate only
+
+    Returns:
+    --------
+    dict: value, ci_low, ci_high
+    """
+    n_items = contributions.shape[0]
+    table_shape = contributions.shape[1:]
+    flat = contributions.reshape(n_items, -1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        value = float(statistic(flat.sum(axis=0).reshape(table_shape)))
+    if n_resamples == 0 or n_items == 0:
+        return {"value": value, "ci_low": np.nan, "ci_high": np.nan}
+
+    rng = np.random.default_rng(seed)
+    block = max(1, block_elements // n_items)
+    samples = []
+    for start in range(0, n_resamples, block):
+        size = min(block, n_resamples - start)
+        drawn = rng.integers(0, n_items, size=(size, n_items))
+        weights = np.bincount((drawn + np.arange(size)[:, None] * n_items).ravel(),
+                              minlength=size * n_items).reshape(size, n_items)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            samples.append(statistic((weights @ flat).reshape(size, *table_shape)))
+
+    low, high = np.nanpercentile(np.concatenate(samples), [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100])
+    return {"value": value, "ci_low": float(low), "ci_high": float(high)}
+
+
+
+def cohen_kappa(df, col_a, col_b, **bootstrap_kwargs):
+    """Cohen's kappa between two label columns, on the rows where both are present."""
+    codes, categories = encode_labels(df, [col_a, col_b])
+    contributions = _cohen_contributions(codes[:, 0], codes[:, 1], len(categories))
+    return bootstrap(contributions, _cohen_statistic, **bootstrap_kwargs)
+
+
+def fleiss_kappa(df, columns, **bootstrap_kwargs):
+    """Fleiss' kappa of the coders in `columns` (items rated by fewer than two are skipped)."""
+    codes, categories = encode_labels(df, columns)
+    contributions = _fleiss_contributions(item_counts(codes, len(categories)))
+    return bootstrap(contributions, _fleiss_statistic, **bootstrap_kwargs)
+
+
+def krippendorff_alpha(df, columns, **bootstrap_kwargs):
+    """Krippendorff's alpha (nominal) of the coders in `columns`, missing labels allowed."""
+    codes, categories = encode_labels(df, columns)
+    contributions = _alpha_contributions(item_counts(codes, len(categories)))
+    return bootstrap(contributions, _alpha_statistic, **bootstrap_kwargs)
+
+
+
+def confusion_matrix(df, row_col, column_col):
+    """
+    Contingency table of two label columns, which may use different label sets
+    (e.g. the cluster names of two annotators).
+    """
+    rows, row_labels = pd.factorize(df[row_col].astype(object), sort=True)
+    cols, col_labels = pd.factorize(df[column_col].astype(object), sort=True)
+    table = contingency_table(rows, cols, len(row_labels), len(col_labels))
+    return pd.DataFrame(table,
+                        index=pd.Index(row_labels, name=row_col),
+                        columns=pd.Index(col_labels, name=column_col))
+
+
+
+def agreement_summary(df, columns, **bootstrap_kwargs):
+    """
+    Fleiss' kappa and Krippendorff's alpha of all `columns`, and Cohen's kappa of
+    every pair of them, with bootstrap intervals.
+
+    Returns:
+    --------
+    pd.DataFrame: one row per metric, with value, ci_low and ci_high
+    """
+    scores = {
+        "fleiss_kappa": fleiss_kappa(df, columns, **bootstrap_kwargs),
+        "krippendorff_alpha": krippendorff_alpha(df, columns, **bootstrap_kwargs),
+    }
+    for col_a, col_b in itertools.combinations(columns, 2):
+        scores[f"cohen_kappa {col_a} - {col_b}"] = cohen_kappa(df, col_a, col_b, **bootstrap_kwargs)
+
+    return pd.DataFrame.from_dict(scores, orient="index")
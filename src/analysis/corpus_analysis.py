@@ -1,13 +1,22 @@
 import pandas as pd
 import numpy as np
 
-import seaborn as sns
-import matplotlib.pyplot as plt
 import textwrap
+import itertools
 
 from typing import Dict
 from collections import Counter
 
+from src.data.filters import ANNOTATORS, LEVELS, UNCERTAIN, UNCLUSTERED, cluster_column, cluster_columns, exclusion_spec, select
+from src.instrumentation import stage
+from src.analysis.agreement_metrics import confusion_matrix, fleiss_kappa, krippendorff_alpha
+
+def remove_unused_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """Drops categories left without rows after filtering, so they are not counted as zeros."""
+    categorical = df.select_dtypes("category").columns
+    return df.assign(**{col: df[col].cat.remove_unused_categories() for col in categorical})
+
+
 class CorpusAnalysis:
     """
     A class for analyzing annotated text corpus with clustering and hate speech labels.
@@ -24,7 +33,7 @@ class CorpusAnalysis:
 
     def __init__(self,df: pd.DataFrame, output_dir: str):
         self.df = df
-        self.df_cluster = df[df["cluster_10_nome_ann02"] !='X']
+        self.df_cluster = remove_unused_categories(select(df, exclusion_spec(levels=[10], values=[UNCLUSTERED])))
         self.output_dir = output_dir
 
         self.dict_english_cl = {
@@ -84,8 +93,8 @@ class CorpusAnalysis:
         print("-" * 50)
 
         # Texts per annotator        
-        texts_per_annotator = self.df.groupby(["annotatore", "id"]).size().reset_index(name='text_count')
-        annotator_summary = texts_per_annotator.groupby("annotatore").size()
+        texts_per_annotator = self.df.groupby(["annotatore", "id"], observed=True).size().reset_index(name='text_count')
+        annotator_summary = texts_per_annotator.groupby("annotatore", observed=True).size()
         stats['texts_per_annotator'] = annotator_summary.to_dict()
         print("Number of texts annotated by each annotator")
         print(annotator_summary)
@@ -99,9 +108,9 @@ class CorpusAnalysis:
         print("-" * 50)
 
         # Mean annotations
-        count_ann_text = self.df.groupby(["annotatore", "id"])["annotazione"].size()
+        count_ann_text = self.df.groupby(["annotatore", "id"], observed=True)["annotazione"].size()
         stats['mean_annotations_per_text'] = count_ann_text.mean()
-        stats['mean_annotations_by_annotator'] = count_ann_text.groupby("annotatore").mean().to_dict()
+        stats['mean_annotations_by_annotator'] = count_ann_text.groupby("annotatore", observed=True).mean().to_dict()
         print("Mean annotations for (annotatore,id):", stats['mean_annotations_per_text'])
 
         return stats
@@ -109,7 +118,7 @@ class CorpusAnalysis:
 
 
     def agents_patients(self):
-        list_annotators = ["annotatore_01", "annotatore_02", "annotatore_03", "annotatore_04", "annotatore_05"]
+        list_annotators = sorted(self.df["annotatore"].dropna().unique())
         dict_agent_pat = {}
 
         for a in list_annotators:
@@ -123,14 +132,14 @@ class CorpusAnalysis:
         count_agent_pat = pd.DataFrame.from_dict(dict_agent_pat, orient='index').reset_index()
         count_agent_pat.rename(columns={'index': 'annotatore'}, inplace=True)
 
-        agent_ann = self.df.groupby(["agent", "annotatore"]).size().reset_index(name='text_count')
+        agent_ann = self.df.groupby(["agent", "annotatore"], observed=True).size().reset_index(name='text_count')
         agent_ann = agent_ann.merge(count_agent_pat[["annotatore", "count_agent"]], on='annotatore', how='left')
 
         agent_ann["percentage"] = ((agent_ann["text_count"] / agent_ann["count_agent"])*100).round(2)
         agent_ann.to_csv(f"{self.output_dir}/agents.csv")
 
 
-        pat_ann = self.df.groupby(["patient", "annotatore"]).size().reset_index(name='text_count')
+        pat_ann = self.df.groupby(["patient", "annotatore"], observed=True).size().reset_index(name='text_count')
         pat_ann = pat_ann.merge(count_agent_pat[["annotatore", "count_patient"]], on='annotatore', how='left')
 
         pat_ann["percentage"] = ((pat_ann["text_count"] / pat_ann["count_patient"])*100).round(2)
@@ -138,10 +147,10 @@ class CorpusAnalysis:
 
         #compute threshold
         print("AGENT threshold")
-        print((agent_ann.groupby("annotatore")["percentage"].mean()))
+        print((agent_ann.groupby("annotatore", observed=True)["percentage"].mean()))
         print()
         print("PATIENT threshold")
-        print((pat_ann.groupby("annotatore")["percentage"].mean()))
+        print((pat_ann.groupby("annotatore", observed=True)["percentage"].mean()))
 
         return agent_ann, pat_ann
 
@@ -149,38 +158,75 @@ class CorpusAnalysis:
 
     def groups_distribution(self, n_groups=5):
 
-        if n_groups==10:
+        if n_groups not in LEVELS:
+            raise ValueError("n_groups must be a int representing the possible number of label groups. Accepted values are 10 or 5")
 
-            print("DISTRIBUTION OF CLUSTERS ACROSS CORPUS - 10")
-            print()
-            print(self.df_cluster["cluster_10_nome_ann05"].value_counts())
-            print()
-            print(self.df_cluster["cluster_10_nome_ann01"].value_counts())
+        print(f"DISTRIBUTION OF CLUSTERS ACROSS CORPUS - {n_groups}")
+        for col in cluster_columns(n_groups):
             print()
-            print(self.df_cluster["cluster_10_nome_ann02"].value_counts())
+            print(self.df_cluster[col].value_counts())
 
-        elif n_groups==5:
-            print("DISTRIBUTION OF CLUSTERS ACROSS CORPUS - 5")
-            print()
-            print(self.df_cluster["cluster_5_nome_ann05"].value_counts())
-            print()
-            print(self.df_cluster["cluster_5_nome_ann01"].value_counts())
-            print()
-            print(self.df_cluster["cluster_5_nome_ann02"].value_counts())
 
-        else:
-            raise ValueError("n_groups must be a int representing the possible number of label groups. Accepted values are 10 or 5")
-        
+
+    def annotator_labels(self, level=5, clusterer="ann05"):
+        """
+        Cluster of each text for each annotator, using the clusters of `clusterer`:
+        one column per annotator, with the most frequent cluster among their
+        annotations of the text (missing when they did not annotate it, or only
+        with uncertain clusters).
+        """
+        col = cluster_column(level, clusterer)
+        df = self.df_cluster[self.df_cluster[col] != UNCERTAIN]
+
+        counts = df.groupby(["id", "annotatore", col], observed=True).size().reset_index(name="n")
+        modal = counts.sort_values("n", ascending=False, kind="stable").drop_duplicates(["id", "annotatore"])
+        table = modal.pivot(index="id", columns="annotatore", values=col)
+        table.columns = table.columns.astype(str)
+        return table.astype(object)
+
+
+
+    def annotator_agreement(self, level=5, n_resamples=1000, seed=42):
+        """
+        Agreement between the annotators of the texts, on the clusters of each
+        clusterer (Fleiss' kappa and Krippendorff's alpha, with 95% bootstrap
+        intervals over texts), and confusion matrices between the clusters of the
+        clusterers, saved in the output directory.
+        """
+        scores = {}
+        for clusterer in ANNOTATORS:
+            table = self.annotator_labels(level, clusterer)
+            for name, metric in (("fleiss_kappa", fleiss_kappa), ("krippendorff_alpha", krippendorff_alpha)):
+                scores[(clusterer, name)] = metric(table, table.columns, n_resamples=n_resamples, seed=seed)
+
+        scores = pd.DataFrame.from_dict(scores, orient="index")
+        print(f"AGREEMENT BETWEEN ANNOTATORS - {level} clusters")
+        print(scores)
+
+        confusion = {}
+        df = self.df_cluster[~self.df_cluster[cluster_columns(level)].isin([UNCERTAIN]).any(axis=1)]
+        for ann_a, ann_b in itertools.combinations(ANNOTATORS, 2):
+            matrix = confusion_matrix(df, cluster_column(level, ann_a), cluster_column(level, ann_b))
+            matrix.to_csv(f"{self.output_dir}/confusion_{level}_{ann_a}_{ann_b}.csv")
+            confusion[(ann_a, ann_b)] = matrix
+
+        return scores, confusion
 
 
 
     def hateful_comments(self):
+        # Plotting libraries are slow to import and only needed here.
+        import seaborn as sns
+        import matplotlib.pyplot as plt
+
         df_cluster_en = self.df_cluster.copy()
 
+        # The loader stores these columns as categoricals: mapped back to plain
+        # values, so that seaborn orders bars and hues by appearance, not by category.
         for col_name, d in self.dict_english_cl.items():
-            df_cluster_en.loc[:, col_name] = self.df_cluster[col_name].map(d)
+            df_cluster_en[col_name] = self.df_cluster[col_name].astype(object).map(d)
             
-        df_cluster_en["hs"] = df_cluster_en["hs"].map({1:"hs", 0:"not hs"})
+        df_cluster_en["hs"] = df_cluster_en["hs"].astype(object).map({1:"hs", 0:"not hs"})
 
 
         # A4 landscape: width x height in inches
@@ -230,23 +276,32 @@ class CorpusAnalysis:
     def generate_full_report(self) -> Dict:
         print("\n1. GENERAL STATISTICS")
         print("-"*30)
-        report = {'general_stats': self.general_statistics()}
+        with stage("corpus_report", section="general_statistics"):
+            report = {'general_stats': self.general_statistics()}
         
         print("\n2. AGENTS AND PATIENTS ANALYSIS")
         print("-"*30)
-        agent_df, patient_df = self.agents_patients()
+        with stage("corpus_report", section="agents_patients"):
+            agent_df, patient_df = self.agents_patients()
         report.update({'agent_analysis': agent_df, 'patient_analysis': patient_df})
         
         print("\n3. CLUSTER DISTRIBUTION (5 clusters)")
         print("-"*30)
-        report['cluster_distribution_5'] = self.groups_distribution(n_groups=5)
+        with stage("corpus_report", section="groups_distribution"):
+            report['cluster_distribution_5'] = self.groups_distribution(n_groups=5)
         
         
-        print("\n4. Running hate speech visualization...")
-        try:
-            report['hate_speech_figure'] = self.hateful_comments()
-        except:
-            report['hate_speech_figure'] = None
+        print("\n4. ANNOTATOR AGREEMENT (5 clusters)")
+        print("-"*30)
+        with stage("corpus_report", section="annotator_agreement"):
+            report['annotator_agreement'], report['cluster_confusion'] = self.annotator_agreement(level=5)
+
+        print("\n5. Running hate speech visualization...")
+        with stage("corpus_report", section="hateful_comments"):
+            try:
+                report['hate_speech_figure'] = self.hateful_comments()
+            except:
+                report['hate_speech_figure'] = None
         
         print("\n" + "="*60)
         print("ANALYSIS COMPLETE - Results saved to:", self.output_dir)
@@ -1,36 +1,88 @@
+import os
+import numpy as np
 import pandas as pd 
 import statistics
-import re
-import ast
+from functools import cached_property
 from typing import Optional, Dict
 
-def task_comparison (df1, df2, df5):
-    df1_ = df1.rename(columns={"parsed_output":"parsed_run_1", "label": "label_run_1"})
-    df2_ = df2.rename(columns={"parsed_output":"parsed_run_2", "label": "label_run_2"})
-    df5_ = df5.rename(columns={"parsed_output":"parsed_run_3", "label": "label_run_3"})
-    
-    df_comparison_ = df1_[['id', '05', '01','02', "parsed_run_1", 'label_run_1']]
-    
-    df_comparison_ = df_comparison_.merge(df2_[['id', '05', '01','02', "parsed_run_2", "label_run_2"]], on=['id', '05', '01','02'])
-    df_comparison = df_comparison_.merge(df5_[['id', '05', '01','02', "parsed_run_3", "label_run_3"]], on=['id', '05', '01','02'])
+from src.data.loader import load_table
+from src.model.parse_output import OPTION_COLUMNS, read_predictions
+from src.instrumentation import stage
+from src.analysis.agreement_metrics import agreement_summary, cohen_kappa, confusion_matrix
+
+def task_comparison (*runs):
+    """
+    Builds the run comparison table with one keyed multi-way join: each parsed run
+    is indexed by (id, 05, 01, 02) and all of them are joined at once, keeping the
+    items parsed in every run, in the order of the first run.
+
+    Returns:
+        pd.DataFrame: id, 05, 01, 02 and, for each run i (from 1),
+        parsed_run_i and label_run_i
+    """
+    key = ['id', '05', '01', '02']
+    indexed = [
+        df.set_index(key)[["parsed_output", "label"]].rename(
+            columns={"parsed_output": f"parsed_run_{i}", "label": f"label_run_{i}"})
+        for i, df in enumerate(runs, start=1)
+    ]
+
+    df_comparison = pd.concat(indexed, axis=1, join="inner", sort=False).reset_index()
 
     print(df_comparison.shape)
 
     return df_comparison
 
 
-def task_agreements(df):
-    # Check if all tasks agree on the label
-    task_cols = ["label_run_1", "label_run_2", "label_run_3"]
-    df["All_agree"] = df[task_cols].nunique(axis=1) == 1
-    # df["All_agree"] = df[task_cols].eq(df["label_run_1"], axis=0).all(axis=1)
+def run_columns(df, prefix):
+    return [col for col in df.columns if col.startswith(prefix)]
+
+
+class RunAgreement:
+    """
+    Agreement between model runs, computed once with NumPy on integer label codes.
+
+    Labels are encoded as small integers (-1 for missing) in an items x runs
+    matrix, from which all masks are derived with array operations instead of
+    a Python call per row.
+
+    Attributes:
+        labels (list): Label of each code
+        codes (np.ndarray): items x runs matrix of label codes
+        n_distinct (np.ndarray): Number of distinct labels given to each item
+        all_agree (np.ndarray): Every run gave the same label
+        all_differ (np.ndarray): The runs gave as many different labels as possible,
+            i.e. min(number of runs, number of possible labels)
+    """
+
+    def __init__(self, df, label_cols, n_labels=None):
+        self.label_cols = list(label_cols)
+        self.labels = sorted(pd.unique(df[self.label_cols].stack().dropna()))
+        # Categorical codes use the smallest integer type that fits (int8 here).
+        self.codes = np.column_stack([
+            pd.Categorical(df[col], categories=self.labels).codes for col in self.label_cols
+        ])
+
+        present = self.codes[:, :, None] == np.arange(len(self.labels))
+        self.n_distinct = present.any(axis=1).sum(axis=1)
 
+        n_labels = n_labels or len(self.labels)
+        self.all_agree = self.n_distinct == 1
+        self.all_differ = self.n_distinct == min(len(self.label_cols), n_labels)
+
+
+    def pairwise(self):
+        """Runs x runs matrix with the share of items on which each pair of runs agrees."""
+        same = (self.codes[:, :, None] == self.codes[:, None, :]) & (self.codes[:, :, None] >= 0)
+        return pd.DataFrame(same.mean(axis=0), index=self.label_cols, columns=self.label_cols)
+
+
+
+def task_agreements(all_agree):
     print("Result explanation (All_agree):")
     print("# True  - All tasks gave the same label")
     print("# False - At least one task gave a different label\n")
-    print(df["All_agree"].value_counts())
-
-    return df
+    print(pd.Series(all_agree, name="All_agree").value_counts())
 
 
 def annotator_distribution(df, annotator_cols, model_parsed_cols):
@@ -56,21 +108,6 @@ def annotator_distribution(df, annotator_cols, model_parsed_cols):
             print("\n\n")
 
 
-def extract_options(text):
-    match = re.search(r"Opzioni:\s*(\[[^\]]+\])", text)
-    if match:
-        raw_list_str = match.group(1)
-        # Replace escaped single quotes \' with normal single quotes '
-        cleaned_str = raw_list_str.replace("\\'", "'")
-        try:
-            # Safely parse the string list into a Python list
-            return ast.literal_eval(cleaned_str)
-        except Exception as e:
-            print(f"Error parsing list: {e}")
-            return None
-    return None
-
-
 def find_winner(row):
     if row["parsed_output"] == row['first_option']:
         return 'first_option'
@@ -82,54 +119,48 @@ def find_winner(row):
         return "no match found"  # No match found
 
 
-def option_number(df):
-    df['first_option'] = df['options'].apply(lambda x: x[0] if isinstance(x, list) and len(x) > 0 else None)
-    df['second_option'] = df['options'].apply(lambda x: x[1] if isinstance(x, list) and len(x) > 1 else None)
-    df['third_option'] = df['options'].apply(lambda x: x[2] if isinstance(x, list) and len(x) > 2 else None)
+RUN_COLUMNS = ['id', '05', '01', '02', 'parsed_output', 'label']
+KEY_COLUMNS = ['id', '05', '01', '02']
 
-    return df
 
+class PredictionsAnalysis:
+    """
+    Compares the parsed outputs of the model runs with each other and with the
+    annotators' labels.
 
+    Input files are only checked for existence when the object is created; each
+    one is read on first access (only the columns the analysis uses) and cached.
+    In particular the classification files are only read by `winning_label`.
+    """
 
-class PredictionsAnalysis:
-    def __init__(self, output_dir, data_paths: Optional[Dict[str, str]] = None):
+    def __init__(self, output_dir, data_paths: Optional[Dict[str, str]] = None, n_runs: int = 3):
         self.output_dir = output_dir
+        self.n_runs = n_runs
+        self.run_numbers = list(range(1, n_runs + 1))
 
         default_paths = {
             'input_file': "O-Ster dataset/preprocessed/data_on5.csv",
             'original_dataset': "O-Ster dataset/original_dataset/open_stereotypes_corpus.csv",
-            'run_1': f"parsed_output/parsed_output_1.csv",
-            'run_2': f"parsed_output/parsed_output_2.csv",  
-            'run_3': f"parsed_output/parsed_output_3.csv",
-            'classification_1': f"predictions/classifications_1.csv",
-            'classification_2': f"predictions/classifications_2.csv",
-            'classification_3': f"predictions/classifications_3.csv"
         }
+        for i in self.run_numbers:
+            default_paths[f'run_{i}'] = f"parsed_output/parsed_output_{i}.csv"
+            default_paths[f'classification_{i}'] = f"predictions/classifications_{i}.csv"
         
         if data_paths:
             default_paths.update(data_paths)
 
-        try:
-            self.input_file = pd.read_csv(default_paths['input_file'])
-            self.original_dataset = pd.read_csv(default_paths['original_dataset'])
-            self.run_1 = pd.read_csv(default_paths['run_1'])
-            self.run_2 = pd.read_csv(default_paths['run_2'])
-            self.run_3 = pd.read_csv(default_paths['run_3'])
-            
-            self.classification_1 = pd.read_csv(default_paths['classification_1'])
-            self.classification_2 = pd.read_csv(default_paths['classification_2'])
-            self.classification_3 = pd.read_csv(default_paths['classification_3'])
-            
-        except FileNotFoundError as e:
-            raise FileNotFoundError(f"Required data file not found: {e}")
-        except Exception as e:
-            raise Exception(f"Error loading data files: {e}")
+        missing = [path for path in default_paths.values() if not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError(f"Required data file not found: {missing}")
 
-        self.list_labels = ["label_run_1", "label_run_2", "label_run_3"]
-        self.list_parsed = ["parsed_run_1", "parsed_run_2",  "parsed_run_3"]
+        self.data_paths = default_paths
+
+        self.list_labels = [f"label_run_{i}" for i in self.run_numbers]
+        self.list_parsed = [f"parsed_run_{i}" for i in self.run_numbers]
         self.list_ann = ["01", "02", "05"]
 
-        self.df_runs_all = task_comparison(self.run_1, self.run_2, self.run_3)
+        self._runs = {}
+        self._classifications = {}
 
 
         # Initialize analysis dataframes
@@ -138,9 +169,64 @@ class PredictionsAnalysis:
         self.all_different_labels = None
 
 
- 
+    def _load(self, name, loader):
+        try:
+            return loader(self.data_paths[name])
+        except FileNotFoundError as e:
+            raise FileNotFoundError(f"Required data file not found: {e}")
+        except Exception as e:
+            raise Exception(f"Error loading data files: {e}")
+
+
+    def _read_run(self, name):
+        return self._load(name, lambda path: pd.read_csv(path, usecols=RUN_COLUMNS, dtype={col: str for col in KEY_COLUMNS}))
+
+
+    def _read_classification(self, name):
+        def loader(path):
+            header = pd.read_csv(path, nrows=0).columns
+            # Compact files store the options in columns: the generated text is not needed.
+            usecols = KEY_COLUMNS + (OPTION_COLUMNS if set(OPTION_COLUMNS).issubset(header) else ['output'])
+            return read_predictions(path, usecols=usecols)
+        return self._load(name, loader)
+
+
+    @cached_property
+    def input_file(self):
+        return self._load('input_file', lambda path: load_table(path, columns=['id']))
+
+    @cached_property
+    def original_dataset(self):
+        return self._load('original_dataset', lambda path: load_table(path, columns=['id', 'tweet']))
+
+    def run(self, i):
+        if i not in self._runs:
+            self._runs[i] = self._read_run(f'run_{i}')
+        return self._runs[i]
+
+    def classification(self, i):
+        if i not in self._classifications:
+            self._classifications[i] = self._read_classification(f'classification_{i}')
+        return self._classifications[i]
+
+    @cached_property
+    def runs_compared(self):
+        return task_comparison(*[self.run(i) for i in self.run_numbers])
+
+    @cached_property
+    def run_agreement(self):
+        # Built once; every agreement mask and statistic is derived from it.
+        return RunAgreement(self.runs_compared, self.list_labels, n_labels=len(self.list_ann))
+
+    @cached_property
+    def df_runs_all(self):
+        df = self.runs_compared
+        df["All_agree"] = self.run_agreement.all_agree
+        return df
+
+
     def hallucination_count(self):
-        list_dfs = [self.run_1, self.run_2, self.run_3]
+        list_dfs = [self.run(i) for i in self.run_numbers]
         avg_hall = []
 
         for run in list_dfs:
@@ -162,8 +248,8 @@ class PredictionsAnalysis:
 
 
     def agreement(self):
-        df = task_agreements(self.df_runs_all)
-        self.df_agreement = df[df["All_agree"] == True]
+        task_agreements(self.run_agreement.all_agree)
+        self.df_agreement = self.df_runs_all[self.run_agreement.all_agree]
         agreement_stats = {}
 
         for run in self.list_labels: 
@@ -184,8 +270,8 @@ class PredictionsAnalysis:
     
 
     def disagreement(self):
-        df = task_agreements(self.df_runs_all)
-        self.df_disagreement = df[df["All_agree"] == False]
+        task_agreements(self.run_agreement.all_agree)
+        self.df_disagreement = self.df_runs_all[~self.run_agreement.all_agree]
     
         disagreement_stats = {}
 
@@ -207,13 +293,9 @@ class PredictionsAnalysis:
 
 
     def all_runs_disagree(self):
-        # Define the condition using apply
-        all_different_labels = self.df_runs_all[
-            self.df_runs_all.apply(
-                lambda row: len(set([row["label_run_1"], row["label_run_2"], row["label_run_3"]])) == 3,
-                axis=1
-            )
-        ]
+        # Items where the runs picked as many different labels as possible (each run a
+        # different one with three runs, every annotator's option with more runs)
+        all_different_labels = self.df_runs_all[self.run_agreement.all_differ]
 
         print(len(all_different_labels))
         all_different_labels = all_different_labels.merge(self.original_dataset[["id", "tweet"]], on="id", how="left")
@@ -235,22 +317,18 @@ class PredictionsAnalysis:
 
     def winning_label(self) -> Dict[str, pd.Series]:
         # Prepare classification data with options
-        classifications = {
-            1: self.classification_1.copy(),
-            2: self.classification_2.copy(), 
-            3: self.classification_3.copy()
-        }
+        classifications = {i: self.classification(i).copy() for i in self.run_numbers}
         
-        runs = {1: self.run_1, 2: self.run_2, 3: self.run_3}
+        runs = {i: self.run(i) for i in self.run_numbers}
         
         winner_stats = {}
         
-        for run_num in [1, 2, 3]:
+        for run_num in self.run_numbers:
             print(f"\n=== Processing Run {run_num} ===")
             
-            # Extract options
-            classifications[run_num]['options'] = classifications[run_num]['output'].apply(extract_options)
-            classifications[run_num] = option_number(classifications[run_num])
+            classifications[run_num] = classifications[run_num].rename(columns={
+                'option_1': 'first_option', 'option_2': 'second_option', 'option_3': 'third_option'
+            })
             
             # Merge with run data
             cr = classifications[run_num].merge(
@@ -311,6 +389,33 @@ class PredictionsAnalysis:
         print(pred_dist)
 
         return {'true_distribution': true_dist, 'predicted_distribution': pred_dist}
+
+
+    def agreement_metrics(self, n_resamples=1000, seed=42):
+        """
+        Chance-corrected agreement, with 95% bootstrap intervals over items: between
+        the parsed outputs of the runs (Fleiss' kappa, Krippendorff's alpha, Cohen's
+        kappa of each pair), and between each run and each annotator (Cohen's kappa,
+        confusion matrix of the annotator's label against the parsed output).
+        """
+        bootstrap_kwargs = {'n_resamples': n_resamples, 'seed': seed}
+
+        runs = agreement_summary(self.df_runs_all, self.list_parsed, **bootstrap_kwargs)
+        print("Agreement between runs:")
+        print(runs)
+
+        model_annotator = {}
+        confusion = {}
+        for parsed in self.list_parsed:
+            for ann in self.list_ann:
+                model_annotator[(parsed, ann)] = cohen_kappa(self.df_runs_all, ann, parsed, **bootstrap_kwargs)
+                confusion[(parsed, ann)] = confusion_matrix(self.df_runs_all, ann, parsed)
+
+        model_annotator = pd.DataFrame.from_dict(model_annotator, orient="index")
+        print("\nAgreement between runs and annotators (Cohen's kappa):")
+        print(model_annotator)
+
+        return {'runs': runs, 'model_annotator': model_annotator, 'confusion': confusion}
     
 
 
@@ -331,37 +436,50 @@ class PredictionsAnalysis:
         # Hallucination analysis
         print("\n1. HALLUCINATION ANALYSIS")
         print("-" * 30)
-        report['hallucination'] = self.hallucination_count()
+        with stage("predictions_report", section="hallucination_count"):
+            report['hallucination'] = self.hallucination_count()
         
         # Agreement analysis  
         print("\n2. AGREEMENT ANALYSIS")
         print("-" * 30)
-        report['agreement_df'] = self.agreement()
+        with stage("predictions_report", section="agreement"):
+            report['agreement_df'] = self.agreement()
+            report['pairwise_agreement'] = self.run_agreement.pairwise()
         
         # Disagreement analysis
         print("\n3. DISAGREEMENT ANALYSIS") 
         print("-" * 30)
-        report['disagreement_df'] = self.disagreement()
+        with stage("predictions_report", section="disagreement"):
+            report['disagreement_df'] = self.disagreement()
         
         # Complete disagreement analysis
         print("\n4. COMPLETE DISAGREEMENT ANALYSIS")
         print("-" * 30)
-        report['all_different_df'] = self.all_runs_disagree()
+        with stage("predictions_report", section="all_runs_disagree"):
+            report['all_different_df'] = self.all_runs_disagree()
         
         # Winner analysis
         print("\n5. OPTION WINNER ANALYSIS")
         print("-" * 30)
-        report['winner_stats'] = self.winning_label()
+        with stage("predictions_report", section="winning_label"):
+            report['winner_stats'] = self.winning_label()
         
         # Distribution comparison
         print("\n6. ANNOTATOR VS MODEL DISTRIBUTION")
         print("-" * 30)
-        self.annotator_vs_label_distr()
+        with stage("predictions_report", section="annotator_vs_label_distr"):
+            self.annotator_vs_label_distr()
         
         # Agreement-specific analysis
         print("\n7. ALL-AGREE ANALYSIS")
         print("-" * 30)
-        report['all_agree_stats'] = self.all_agree()
+        with stage("predictions_report", section="all_agree"):
+            report['all_agree_stats'] = self.all_agree()
+
+        print("\n8. AGREEMENT METRICS")
+        print("-" * 30)
+        with stage("predictions_report", section="agreement_metrics"):
+            report['agreement_metrics'] = self.agreement_metrics()
         
         print("\n" + "="*60)
         print("ANALYSIS COMPLETE - Results saved to:", self.output_dir)
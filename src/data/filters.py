@@ -0,0 +1,58 @@
+import numpy as np
+
+
+# Annotators whose labels were grouped into clusters, and the available levels.
+ANNOTATORS = ["ann01", "ann02", "ann05"]
+LEVELS = [5, 10]
+
+# Sentinel labels
+UNCERTAIN = "None/Doubt"
+UNCLUSTERED = "X"
+
+
+def cluster_column(level, annotator, named=True):
+    """Name of the column with the `level`-cluster label (or its number) of `annotator`."""
+    if level not in LEVELS:
+        raise ValueError(f"level must be one of {LEVELS}")
+    return f"cluster_{level}_nome_{annotator}" if named else f"cluster_{level}_{annotator}"
+
+
+def cluster_columns(level, annotators=None, named=True):
+    return [cluster_column(level, annotator, named) for annotator in (annotators or ANNOTATORS)]
+
+
+def exclusion_spec(levels, values, annotators=None, required=()):
+    """
+    Builds a selection spec dropping rows where any annotator's cluster label, at
+    any of `levels`, is one of `values`, and rows with missing `required` columns.
+
+    The spec is a plain dict (hashable through json, so it can key cached outputs):
+        {"required": [column, ...], "excluded": {column: [value, ...], ...}}
+    """
+    excluded = {}
+    for level in levels:
+        for col in cluster_columns(level, annotators):
+            excluded[col] = list(values)
+    return {"required": list(required), "excluded": excluded}
+
+
+def build_mask(df, spec):
+    """
+    Combines every condition of `spec` into a single boolean mask, without
+    materializing the intermediate filtered frames. Excluded-value columns missing
+    from `df` (e.g. annotators not in this file) are skipped.
+    """
+    mask = np.ones(len(df), dtype=bool)
+
+    for col in spec.get("required", []):
+        mask &= df[col].notna().to_numpy()
+
+    for col, values in spec.get("excluded", {}).items():
+        if col in df.columns:
+            mask &= ~df[col].isin(values).to_numpy()
+
+    return mask
+
+
+def select(df, spec):
+    return df[build_mask(df, spec)]
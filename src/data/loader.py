@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # pragma: no cover - the csv is read directly
+    pa = None
+
+
+CORPUS_PATH = "O-Ster dataset/original_dataset/open_stereotypes_corpus.csv"
+
+# Low-cardinality columns of the corpus (and of the files derived from it).
+CATEGORICAL_COLUMNS = [
+    "annotatore",
+    "cluster_10_nome_ann01", "cluster_5_nome_ann01",
+    "cluster_10_nome_ann02", "cluster_5_nome_ann02",
+    "cluster_10_nome_ann05", "cluster_5_nome_ann05",
+    "agent", "patient", "hs",
+    "time", "source", "note", "set", "target",
+]
+
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+
+def _csv_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+
+def cache_path(csv_path):
+    return f"{csv_path}.arrow"
+
+
+
+def _cache_is_valid(csv_path, meta_path):
+    if not (os.path.exists(cache_path(csv_path)) and os.path.exists(meta_path)):
+        return False
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    signature = _csv_signature(csv_path)
+    if meta["size"] == signature["size"] and meta["mtime_ns"] == signature["mtime_ns"]:
+        return True
+
+    # Touched (e.g. by a checkout) but possibly unchanged: compare contents.
+    if meta["size"] == signature["size"] and meta["sha256"] == _file_hash(csv_path):
+        with open(meta_path, "w") as f:
+            json.dump({**meta, **signature}, f)
+        return True
+
+    return False
+
+
+
+def load_table(csv_path, categorical_columns=CATEGORICAL_COLUMNS, columns=None):
+    """
+    Loads a csv through a columnar Arrow cache stored next to it (`<csv>.arrow`).
+
+    The first call converts the csv, with `categorical_columns` stored as
+    dictionary-encoded (categorical) columns; later calls memory-map the Arrow
+    file instead of parsing the csv again. The cache is rebuilt when the csv
+    changes (size/mtime, then sha256 of its content). Without pyarrow the csv is
+    read directly.
+
+    Parameters:
+    -----------
+    csv_path : str
+        - path of the csv file
+    categorical_columns : list
+        - columns converted to the pandas category dtype, when present
+    columns : list
+        - only return these columns (only these are read from a valid cache)
+
+    Returns:
+    --------
+    df: pandas.DataFrame
+    """
+    meta_path = f"{cache_path(csv_path)}.json"
+
+    if pa is not None and _cache_is_valid(csv_path, meta_path):
+        table = feather.read_table(cache_path(csv_path), columns=columns, memory_map=True)
+        return table.to_pandas()
+
+    df = pd.read_csv(csv_path)
+    for col in categorical_columns:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    if pa is not None:
+        # Uncompressed, so that the file can be memory-mapped.
+        feather.write_feather(df, cache_path(csv_path), compression="uncompressed")
+        with open(meta_path, "w") as f:
+            json.dump({**_csv_signature(csv_path), "sha256": _file_hash(csv_path)}, f)
+
+    return df if columns is None else df[columns]
+
+
+
+def load_corpus(path=CORPUS_PATH):
+    return load_table(path)
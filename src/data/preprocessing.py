@@ -1,6 +1,132 @@
+import os
+import json
+import hashlib
+import numpy as np
 import pandas as pd
 
-def cluster_based_filter(df):
+from src.data.loader import load_table
+from src.data.filters import UNCERTAIN, cluster_column, cluster_columns, exclusion_spec, select
+
+
+PREPROCESSED_DIR = "./O-Ster dataset/preprocessed"
+
+# Parameters of the cluster filter; cached views are invalidated when they change.
+FILTER_PARAMS = {
+    **exclusion_spec(levels=[10, 5], values=[UNCERTAIN], required=[cluster_column(10, "ann05", named=False)]),
+    "views": {
+        "on10": ["id"] + cluster_columns(10),
+        "on5": ["id"] + cluster_columns(5),
+    },
+}
+
+
+def remove_uncertain(df, params=FILTER_PARAMS):
+    return select(df, params)
+
+
+def _rows_digest(row_hashes):
+    return hashlib.sha256(np.ascontiguousarray(row_hashes).tobytes()).hexdigest()
+
+
+class ClusterViews:
+    """
+    Lazy, cached 10- and 5-cluster views of the O-Ster dataset.
+
+    A view is only computed (and written to `<output_dir>/data_<name>.csv`) when
+    it is accessed. A manifest next to the files records, for each view, the
+    filter parameters and a digest of the corpus rows it was computed from:
+
+    - same parameters and same rows: the csv written last time is reused
+    - same parameters and the corpus only had rows appended: only the new rows
+      are filtered and deduplicated against the cached view
+    - otherwise the view is recomputed
+
+    Attributes:
+        df (pd.DataFrame): The O-Ster dataset
+        output_dir (str): Directory of the view files and of the manifest
+        params (Dict): Filter parameters (see FILTER_PARAMS)
+    """
+
+    def __init__(self, df, output_dir=PREPROCESSED_DIR, params=FILTER_PARAMS):
+        self.df = df
+        self.output_dir = output_dir
+        self.params = params
+        self.params_hash = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+        self.manifest_path = f"{output_dir}/.filter_manifest.json"
+        self._views = {}
+        self._row_hashes = None
+
+
+    @property
+    def on10(self):
+        return self.view("on10")
+
+
+    @property
+    def on5(self):
+        return self.view("on5")
+
+
+    def row_hashes(self):
+        if self._row_hashes is None:
+            self._row_hashes = pd.util.hash_pandas_object(self.df, index=False).to_numpy()
+        return self._row_hashes
+
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+
+    def _write_manifest(self, name, entry):
+        manifest = self._read_manifest()
+        manifest[name] = entry
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+
+    def view(self, name):
+        if name in self._views:
+            return self._views[name]
+
+        path = f"{self.output_dir}/data_{name}.csv"
+        subset = self.params["views"][name]
+        row_hashes = self.row_hashes()
+        entry = self._read_manifest().get(name)
+
+        valid = (entry is not None and entry["params"] == self.params_hash and os.path.exists(path)
+                 and entry["n_rows"] <= len(self.df)
+                 and entry["rows"] == _rows_digest(row_hashes[:entry["n_rows"]]))
+
+        if valid and entry["n_rows"] == len(self.df):
+            view = load_table(path)
+            print(f"Dataframe based on {name[2:]} clusters (cached)", view.shape)
+            self._views[name] = view
+            return view
+
+        if valid:
+            # Appended rows only: filtering is row-wise and deduplication keeps the
+            # first occurrence, so this gives the same result as a full recompute.
+            new_rows = remove_uncertain(self.df.iloc[entry["n_rows"]:], self.params)
+            print(f"Filtering {len(self.df) - entry['n_rows']} new annotation rows")
+            view = pd.concat([load_table(path), new_rows], ignore_index=True)
+        else:
+            view = remove_uncertain(self.df, self.params)
+            print("Dataframe without empty clusters", view.shape)
+
+        view = view.drop_duplicates(subset=subset)
+        print(f"Dataframe based on {name[2:]} clusters", view.shape)
+        view.to_csv(path, index=False)
+
+        self._write_manifest(name, {"params": self.params_hash, "n_rows": len(self.df),
+                                    "rows": _rows_digest(row_hashes)})
+        self._views[name] = view
+        return view
+
+
+def cluster_based_filter(df, output_dir=PREPROCESSED_DIR):
 
     """
     Filters and processes a dataframe based on cluster annotations, removing uncertain 
@@ -10,6 +136,8 @@ def cluster_based_filter(df):
     -----------
     df : pandas.DataFrame
         - the O-Ster dataset
+    output_dir : str
+        - directory of the preprocessed files
     
     Returns:
     --------
@@ -18,29 +146,14 @@ def cluster_based_filter(df):
     
     Output Files:
     -------------
-    - "./O-Ster dataset/preprocessed/data_on10.csv": Deduplicated dataset based on 
-      10-cluster 
     - "./O-Ster dataset/preprocessed/data_on5.csv": Deduplicated dataset based on 
-      5-cluster 
+      5-cluster, only rewritten when the corpus or the filter changed
     
     Notes:
     ------
     - Print statements show dataset size reduction at each step
+    - The 10-cluster view ("data_on10.csv") is available lazily through
+      `ClusterViews(df).on10`
     """
 
-    df = df.dropna(subset=["cluster_10_ann05"])
-    df = df[df["cluster_10_nome_ann02"] !='None/Doubt']
-    df = df[df["cluster_5_nome_ann02"] !='None/Doubt']
-
-
-    print("Dataframe without empty clusters", df.shape)
-    df_on10 = df.drop_duplicates(subset=["id", "cluster_10_nome_ann01", "cluster_10_nome_ann02", "cluster_10_nome_ann05"])
-    print("Dataframe based on 10 clusters", df_on10.shape)
-    df_on10.to_csv("./O-Ster dataset/preprocessed/data_on10.csv", index=False)
-
-
-    df_on5 = df.drop_duplicates(subset=["id", "cluster_5_nome_ann01", "cluster_5_nome_ann02", "cluster_5_nome_ann05"])
-    print("Dataframe based on 5 clusters", df_on5.shape)
-    df_on5.to_csv("./O-Ster dataset/preprocessed/data_on5.csv", index=False)
-
-    return df_on5
\ No newline at end of file
+    return ClusterViews(df, output_dir=output_dir).on5
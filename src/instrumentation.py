@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import resource
+import contextlib
+import tracemalloc
+
+
+# Records are appended, one JSON object per line, to the file named by this
+# variable. Using the environment (rather than module state) lets the worker
+# processes of a sharded run report to the same file.
+METRICS_ENV = "OSTER_METRICS_FILE"
+
+PROFILE_MODES = ["cprofile", "tracemalloc"]
+
+
+
+def configure(metrics_file=None):
+    """Sends the records of this process (and of the processes it starts) to `metrics_file`."""
+    if metrics_file:
+        os.environ[METRICS_ENV] = os.path.abspath(metrics_file)
+    else:
+        os.environ.pop(METRICS_ENV, None)
+
+
+
+def enabled():
+    return METRICS_ENV in os.environ
+
+
+
+def memory():
+    """Current and peak resident memory of the process, in MB (current only on Linux)."""
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS).
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    usage = {"peak_rss_mb": round(peak / 2 ** 20, 1)}
+
+    try:
+        with open("/proc/self/statm") as f:
+            usage["rss_mb"] = round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+    except OSError:
+        pass
+
+    if tracemalloc.is_tracing():
+        current, traced_peak = tracemalloc.get_traced_memory()
+        usage["traced_mb"] = round(current / 2 ** 20, 1)
+        usage["traced_peak_mb"] = round(traced_peak / 2 ** 20, 1)
+
+    return usage
+
+
+
+def emit(event, **fields):
+    """Appends one record to the metrics file, when one is configured."""
+    if not enabled():
+        return
+
+    record = {"event": event, "time": round(time.time(), 3), "pid": os.getpid(), **fields}
+    # One write per line, in append mode, so concurrent processes do not interleave.
+    with open(os.environ[METRICS_ENV], "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Times a pipeline stage and emits a `stage` record when it ends, with its
+    duration, memory and any fields set on the yielded dict (e.g. `rows`, from
+    which the throughput is computed). Does nothing but time the block when no
+    metrics file is configured.
+
+        with stage("parse", run=1) as metrics:
+            ...
+            metrics["rows"] = len(df)
+    """
+    metrics = dict(fields)
+    if enabled() and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        seconds = time.perf_counter() - start
+        if enabled():
+            if metrics.get("rows") and seconds > 0:
+                metrics["rows_per_second"] = round(metrics["rows"] / seconds, 1)
+            emit("stage", stage=name, seconds=round(seconds, 4), **metrics, **memory())
+
+
+
+@contextlib.contextmanager
+def profile(mode, output=None, top=25):
+    """
+    Profiles the block with cProfile or tracemalloc.
+
+    - cprofile: the statistics are dumped to `output` (for pstats/snakeviz) when
+      given, and the `top` functions by cumulative time are printed to stderr
+    - tracemalloc: stage records get traced memory fields, and the `top`
+      allocation sites at the end of the block are printed to stderr
+    """
+    if mode is None:
+        yield
+        return
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"profile mode must be one of {PROFILE_MODES}")
+
+    if mode == "cprofile":
+        import pstats
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output:
+                profiler.dump_stats(output)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(top)
+        return
+
+    tracemalloc.start(10)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"tracemalloc peak: {peak / 2 ** 20:.1f} MB", file=sys.stderr)
+        for statistic in snapshot.statistics("lineno")[:top]:
+            print(statistic, file=sys.stderr)
+        if output:
+            snapshot.dump(output)
@@ -0,0 +1,100 @@
+import json
+import time
+import sqlite3
+import hashlib
+
+
+
+class InferenceCache:
+    """
+    On-disk cache of model outputs, stored in SQLite.
+
+    Entries are addressed by a hash of model id, prompt text, seed and generation
+    parameters, so rerunning `classify` after changing the filters or the label
+    dictionaries only pays for prompts that were never seen. When `max_bytes` is
+    set, the least recently used entries are evicted once the stored outputs
+    exceed it.
+
+    Attributes:
+        path (str): Path of the SQLite database
+        max_bytes (int): Size limit of the stored outputs, None for no limit
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        # Sharded workers may share the same database.
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS outputs_last_access ON outputs (last_access)")
+        self.connection.commit()
+
+
+    @staticmethod
+    def key(model_id, prompt, seed, params):
+        payload = json.dumps([model_id, prompt, seed, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(keys)
+
+        # SQLite limits the number of bound parameters per statement.
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT key, value FROM outputs WHERE key IN ({placeholders})", chunk
+            ).fetchall()
+            found.update((key, json.loads(value)) for key, value in rows)
+
+        if found:
+            now = time.time()
+            self.connection.executemany("UPDATE outputs SET last_access = ? WHERE key = ?",
+                                        [(now, key) for key in found])
+            self.connection.commit()
+
+        return found
+
+
+    def put_many(self, items):
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value, ensure_ascii=False)
+            rows.append((key, value, len(value.encode("utf-8")), now))
+
+        self.connection.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+        if self.max_bytes is not None:
+            self.evict()
+
+
+    def size(self):
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM outputs").fetchone()[0]
+
+
+    def evict(self):
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+
+        to_delete = []
+        for key, size in self.connection.execute("SELECT key, size FROM outputs ORDER BY last_access"):
+            to_delete.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+
+        self.connection.executemany("DELETE FROM outputs WHERE key = ?", to_delete)
+        self.connection.commit()
+
+
+    def close(self):
+        self.connection.close()
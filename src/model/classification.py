@@ -1,15 +1,52 @@
+import os
+import numpy as np
 import pandas as pd
+import copy
+import hashlib
+import itertools
 import random
-import csv
+import time
 import transformers
 import torch
 from tqdm import tqdm
 
+from src.data.filters import UNCERTAIN, cluster_column, exclusion_spec, select
+from src.instrumentation import emit, stage
+from src.model.cache import InferenceCache
+from src.model.parse_output import OPTION_COLUMNS, read_predictions
+from src.model.writer import PredictionWriter, prediction_key
 
 
-def create_prompt(row,seed):
-  
-  text = row["tweet"]
+# Text shown to the model for each annotator's 5-cluster labels.
+LABEL_TEXT = {
+    'ann05': {'SonoSfruttatori': "Sono degli sfruttatori",
+              'SonoMinaccia': "Sono una minaccia",
+              'RovinanoItalia': "Rovinano l'Italia",
+              'SonoTutelati': "Sono tutelati",
+              'SonoEstremistiReligiosi': "Sono degli estremisti religiosi"},
+
+    'ann01': {'SonoParassiti': "Sono dei parassiti",
+              'SonoSubdoli': "Sono subdoli",
+              'SonoImmorali': "Sono immorali",
+              'SonoIncompatibiliConNoi': "Sono incompatibili con noi",
+              'SonoProblema': "Sono un problema"},
+
+    'ann02': {'FannoQuelloCheVoglionoSenzaContribuire':  "Fanno quello che vogliono senza contribuire",
+              'SonoPericolosi': "Sono pericolosi",
+              'PeggioranoLeNostreCondizioniDiVita': "Peggiorano le nostre condizioni di vita",
+              'HannoCulturaDiversaDallaNostra': "Hanno una cultura diversa dalla nostra",
+              'PortanoDegrado': "Portano degrado"},
+}
+
+PROMPT_ANNOTATORS = ['ann05', 'ann01', 'ann02']
+
+# The six orderings of the three options.
+PERMUTATIONS = np.array(list(itertools.permutations(range(3))))
+
+
+
+def shuffle_options(row,seed):
+
   opt_ann05 = row['cleaned_cl_ann05']
   opt_ann01 = row['cleaned_cl_ann01']
   opt_ann02 = row['cleaned_cl_ann02']
@@ -17,6 +54,12 @@ def create_prompt(row,seed):
   list_options = [opt_ann05, opt_ann01, opt_ann02]
   random.shuffle(list_options)
 
+  return list_options
+
+
+
+def format_prompt(text, list_options):
+
   instruction = {"prelude": "Ti viene fornita in input (Input) una frase estratta dai social media, insieme a tre possibili stereotipi (Opzioni).",
         "task": "Il tuo compito è individuare quale stereotipo è implicito nella frase, scegliendo tra le opzioni fornite." ,
         "instr": "Restituisci in output (Output) una singola opzione, sotto forma di lista Python (es. ['Opzione 1']).",
@@ -30,73 +73,791 @@ def create_prompt(row,seed):
 
 
 
-def classify(df, pred_path, processed_fileame, prediction_filename, seed=42):
-    file = open(f'{pred_path}/{prediction_filename}.csv',mode='w')
+def prompt_prefix():
+    # Everything before the tweet is the same for every row.
+    return format_prompt("", []).split("\n")[0] + "\n"
 
-    writer = csv.DictWriter(file,fieldnames=['id','span','output',"05","01","02"])
-    writer.writeheader()
 
 
-    df = df[df["cluster_5_nome_ann02"] != 'None/Doubt']
-    df = df[df["cluster_5_nome_ann02"] != 'None/Doubt']
+def create_prompt(row,seed):
 
-    dict_ann05 =  {'SonoSfruttatori': "Sono degli sfruttatori",
-               'SonoMinaccia': "Sono una minaccia",
-               'RovinanoItalia': "Rovinano l'Italia",
-               'SonoTutelati': "Sono tutelati",
-               'SonoEstremistiReligiosi': "Sono degli estremisti religiosi"}
+  return format_prompt(row["tweet"], shuffle_options(row, seed))
+
+
+
+def build_prompts(df, seed):
+    """
+    Vectorized version of `create_prompt` for a whole dataframe.
+
+    Each row gets its own permutation of the three options, chosen by a hash of
+    the row itself (id and options) keyed with `seed`, so the ordering is
+    reproducible and does not depend on the row's position: a shard, or a
+    dataset with rows added or removed, gets the same prompts for the rows it
+    shares with another. Missing options are shown as `nan`, like `create_prompt`
+    does. The hashes and the prompts are computed column-wise.
+
+    Returns:
+        pandas.DataFrame: same index as `df`, with the shuffled options
+        (`option_1`, `option_2`, `option_3`), the position (1 to 3) each
+        annotator's option got (`pos_05`, `pos_01`, `pos_02`) and the `prompt`
+    """
+    n = len(df)
+    annotator_cols = [f'cleaned_cl_{ann}' for ann in PROMPT_ANNOTATORS]
+
+    # The seed keys the hash (SipHash takes a 16 character key).
+    hash_key = hashlib.md5(str(seed).encode("utf-8")).hexdigest()[:16]
+    row_hashes = pd.util.hash_pandas_object(df[['id'] + annotator_cols].astype(object), index=False, hash_key=hash_key)
+    permutation = PERMUTATIONS[(row_hashes.to_numpy() % len(PERMUTATIONS)).astype(np.int64)]
+
+    # Options are taken from a handful of label phrases: their Python repr (as
+    # printed inside the options list) is computed once per distinct phrase.
+    codes, uniques = pd.factorize(pd.concat([df[col].astype(object) for col in annotator_cols]), use_na_sentinel=False)
+    codes = codes.reshape(3, n).T
+    reprs = np.array([repr(u) for u in uniques], dtype=object)
+
+    shuffled = np.take_along_axis(codes, permutation, axis=1)
+    option_values = np.asarray(uniques, dtype=object)
+
+    prompts = pd.DataFrame(index=df.index)
+    for j in range(3):
+        prompts[f'option_{j + 1}'] = option_values[shuffled[:, j]]
+    for k, ann in enumerate(PROMPT_ANNOTATORS):
+        prompts[f'pos_{ann[3:]}'] = np.argmax(permutation == k, axis=1) + 1
+
+    # Object arrays rather than Series, whose string dtype cannot be added to object
+    # columns (e.g. when `df` is empty).
+    options_list = "[" + reprs[shuffled[:, 0]] + ", " + reprs[shuffled[:, 1]] + ", " + reprs[shuffled[:, 2]] + "]"
+    tweets = df["tweet"].map(str).to_numpy(dtype=object)
+    prompts['prompt'] = prompt_prefix() + " Input: " + tweets + "\n Opzioni: " + options_list + "\n Output:"
+
+    return prompts
+
+
+
+PRECISIONS = ["bf16", "fp32", "int8"]
+
+# Written by `save_quantized_model`: the int8 weights as plain tensors, next to the config.
+QUANTIZED_MODEL_FILE = "model_int8.safetensors"
+
+
+
+def quantize_linear_layers(model):
+    """
+    Replaces every linear layer of `model` with a dynamically quantized one (int8
+    weights, activations quantized on the fly), on CPU. Layers are converted one
+    at a time, so at most one of them is held in float32 next to the model; the
+    other weights (embeddings, norms) are then converted to float32, the input
+    type of the quantized layers.
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, torch.nn.Linear):
+                child = child.float()
+                child.qconfig = torch.ao.quantization.default_dynamic_qconfig
+                setattr(module, name, torch.ao.nn.quantized.dynamic.Linear.from_float(child))
+    return model.float()
+
+
+
+def save_quantized_model(model, output_dir):
+    """
+    Saves a model quantized by `quantize_linear_layers` and its config to
+    `output_dir`. Quantized tensors cannot go through safetensors (and pickling
+    them is fragile), so each quantized layer is stored as plain tensors: int8
+    weight values, scale, zero point and bias.
+    """
+    from safetensors.torch import save_file
+
+    tensors = {}
+    for name, module in model.named_modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = module._weight_bias()
+            tensors[f"{name}.weight"] = weight.int_repr()
+            tensors[f"{name}.weight_scale"] = torch.tensor(weight.q_scale(), dtype=torch.float64)
+            tensors[f"{name}.weight_zero_point"] = torch.tensor(weight.q_zero_point(), dtype=torch.int64)
+            if bias is not None:
+                tensors[f"{name}.bias"] = bias
+        else:
+            prefix = f"{name}." if name else ""
+            for key, tensor in module.named_parameters(recurse=False):
+                tensors[prefix + key] = tensor.detach()
+            for key, tensor in module.named_buffers(recurse=False):
+                if key not in module._non_persistent_buffers_set:
+                    tensors[prefix + key] = tensor
+
+    os.makedirs(output_dir, exist_ok=True)
+    model.config.save_pretrained(output_dir)
+
+    # Written under a temporary name, so that an interrupted save does not leave
+    # a truncated file that `load_model` would pick up.
+    path = os.path.join(output_dir, QUANTIZED_MODEL_FILE)
+    save_file({key: tensor.contiguous() for key, tensor in tensors.items()}, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+
+def load_quantized_model(model_dir):
+    """
+    Loads a model saved by `save_quantized_model`. The model is created without
+    allocating its weights (on the meta device), its linear layers are replaced
+    by quantized ones holding the saved int8 weights, and the other weights are
+    assigned from the file, so the bf16 or float32 weights are never materialized.
+    """
+    from accelerate import init_empty_weights
+    from safetensors import safe_open
+
+    config = transformers.AutoConfig.from_pretrained(model_dir)
+    with init_empty_weights():
+        model = transformers.AutoModelForCausalLM.from_config(config)
+
+    linear_names = [name for name, module in model.named_modules() if isinstance(module, torch.nn.Linear)]
+    quantized_keys = {f"{name}.{suffix}" for name in linear_names
+                      for suffix in ("weight", "weight_scale", "weight_zero_point", "bias")}
+
+    # Tensors are read from the file one at a time, as they are assigned.
+    with safe_open(os.path.join(model_dir, QUANTIZED_MODEL_FILE), framework="pt") as f:
+        keys = set(f.keys())
+        missing, unexpected = model.load_state_dict(
+            {key: f.get_tensor(key) for key in keys - quantized_keys}, strict=False, assign=True)
+        missing = [key for key in missing if key not in quantized_keys]
+        if missing or unexpected:
+            raise ValueError(f"{model_dir} does not match its config: missing {missing}, unexpected {unexpected}")
+
+        for name in linear_names:
+            parent_name, _, child_name = name.rpartition(".")
+            child = model.get_submodule(name)
+            weight = torch._make_per_tensor_quantized_tensor(f.get_tensor(f"{name}.weight"),
+                                                             f.get_tensor(f"{name}.weight_scale").item(),
+                                                             f.get_tensor(f"{name}.weight_zero_point").item())
+            bias = f.get_tensor(f"{name}.bias") if f"{name}.bias" in keys else None
+            quantized = torch.ao.nn.quantized.dynamic.Linear(child.in_features, child.out_features,
+                                                             bias_=child.bias is not None)
+            quantized.set_weight_bias(weight, bias)
+            setattr(model.get_submodule(parent_name), child_name, quantized)
+
+    return model.float()
+
+
+
+def load_model(model_id, seed, precision="bf16"):
+    """
+    Loads the tokenizer and the model with the given precision:
+
+    - bf16, fp32: weights in that type, placed by `device_map="auto"`
+    - int8: linear layers dynamically quantized to int8, on CPU (see
+      `quantize_linear_layers`); about half the memory of bf16
+
+    When `model_id` is a directory written by `save_quantized`, its int8 weights
+    are loaded directly (see `load_quantized_model`), whatever `precision` is.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}")
 
-    dict_ann01 =  {'SonoParassiti': "Sono dei parassiti",
-               'SonoSubdoli': "Sono subdoli",
-               'SonoImmorali': "Sono immorali",
-               'SonoIncompatibiliConNoi': "Sono incompatibili con noi",
-               'SonoProblema': "Sono un problema"}
+    transformers.set_seed(seed)
 
-    dict_ann02 = {'FannoQuelloCheVoglionoSenzaContribuire':  "Fanno quello che vogliono senza contribuire",
-            'SonoPericolosi': "Sono pericolosi",
-            'PeggioranoLeNostreCondizioniDiVita': "Peggiorano le nostre condizioni di vita",
-            'HannoCulturaDiversaDallaNostra': "Hanno una cultura diversa dalla nostra",
-            'PortanoDegrado': "Portano degrado"}
+    # Decoder-only models must be padded on the left so that every prompt in a
+    # batch ends right where generation starts.
+    tokenizer = transformers.AutoTokenizer.from_pretrained(model_id, padding_side="left")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
 
-    df["cleaned_cl_ann05"] = df["cluster_5_nome_ann05"].map(dict_ann05)
-    df["cleaned_cl_ann01"] = df["cluster_5_nome_ann01"].map(dict_ann01)
-    df["cleaned_cl_ann02"] = df["cluster_5_nome_ann02"].map(dict_ann02)
+    if os.path.isfile(os.path.join(model_id, QUANTIZED_MODEL_FILE)):
+        model = load_quantized_model(model_id)
+    elif precision == "int8":
+        model = transformers.AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.bfloat16)
+        model = quantize_linear_layers(model)
+    else:
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            model_id,
+            device_map="auto",
+            torch_dtype=torch.bfloat16 if precision == "bf16" else torch.float32,
+        )
+    model.eval()
 
+    return tokenizer, model
 
-    df = df [['id', 'annotatore', 'tweet', 'chunk', 'annotazione','annotazioni_parsate',
-          'cleaned_cl_ann05', 'cleaned_cl_ann01', 'cleaned_cl_ann02']]
 
-    dataset = df
-    print(len(dataset))
 
-    dataset["prompt"] = dataset.apply(lambda row: create_prompt(row, seed), axis=1)
+def save_quantized(model_id, output_dir, seed=42):
+    """
+    Quantizes `model_id` to int8 once and saves it with its tokenizer to
+    `output_dir`, which can then be passed as model id to skip the quantization.
+    """
+    tokenizer, model = load_model(model_id, seed, precision="int8")
 
-    dataset.to_csv(f'{pred_path}/{processed_fileame}.csv',index=False)
+    save_quantized_model(model, output_dir)
+    tokenizer.save_pretrained(output_dir)
 
 
 
-    model_id = "sapienzanlp/Minerva-7B-instruct-v1.0"  # Replace with a compatible model ID
+def length_buckets(lengths, batch_size, groups=None):
+    """
+    Groups row positions into batches of prompts with similar token length, so
+    that short tweets are not padded up to the longest prompt of the dataset.
 
+    When `groups` is given, rows of the same group (e.g. the option permutations
+    of the same tweet across runs) are kept next to each other.
+    """
+    if groups is None:
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    else:
+        group_length = {}
+        for group, length in zip(groups, lengths):
+            group_length[group] = max(length, group_length.get(group, 0))
+        order = sorted(range(len(lengths)), key=lambda i: (group_length[groups[i]], groups[i], lengths[i]))
 
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
 
-    transformers.set_seed(seed)
 
-    # Initialize the pipeline.
-    pipeline = transformers.pipeline(
-    "text-generation",
-    model=model_id,
-    device_map="auto",
-    model_kwargs={"torch_dtype": torch.bfloat16},
-)
 
+class PrefixCache:
+    """
+    Key/value cache of the instruction block shared by every prompt.
+
+    The prefix is run through the model once; each batch then starts from a copy
+    of its cache, so only the tweet and the options are encoded per row. Prompts
+    are tokenized in full and the prefix tokens are stripped afterwards, so the
+    token ids seen by the model are exactly those of the uncached prompt; batches
+    with a prompt whose tokenization does not start with the prefix are encoded
+    without the cache (counted in `misses`).
+    """
+
+    def __init__(self, tokenizer, model, prefix):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.ids = tokenizer(prefix)["input_ids"]
+        self.misses = 0
+
+        with torch.no_grad():
+            input_ids = torch.tensor([self.ids], device=model.device)
+            self.past_key_values = model(input_ids, use_cache=True).past_key_values
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def matches(self, prompt_ids):
+        return prompt_ids[:len(self.ids)] == self.ids
+
+
+    def encode(self, prompts):
+        """Encodes a batch on top of the prefix cache, or returns None when a prompt does not match it."""
+        prompt_ids = self.tokenizer(prompts)["input_ids"]
+        if not all(self.matches(ids) for ids in prompt_ids):
+            self.misses += 1
+            return None
+
+        suffix = self.tokenizer.pad({"input_ids": [ids[len(self.ids):] for ids in prompt_ids]},
+                                    return_tensors="pt").to(self.model.device)
+        n = len(prompts)
+        prefix_ids = torch.tensor([self.ids], device=self.model.device).expand(n, -1)
+
+        input_ids = torch.cat([prefix_ids, suffix["input_ids"]], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids), suffix["attention_mask"]], dim=1)
+
+        past_key_values = copy.deepcopy(self.past_key_values)
+        past_key_values.batch_repeat_interleave(n)
+
+        return input_ids, attention_mask, past_key_values
+
+
+
+def encode_prompts(tokenizer, model, prompts, prefix_cache=None):
+    """
+    Returns input ids, attention mask and, when a prefix cache is used, the key/value
+    cache already covering the prefix tokens. With the cache the padding sits between
+    prefix and tweet; position ids are derived from the attention mask, so it is
+    equivalent to left padding.
+    """
+    if prefix_cache is not None:
+        encoded = prefix_cache.encode(prompts)
+        if encoded is not None:
+            return encoded
+
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    return inputs["input_ids"], inputs["attention_mask"], None
+
+
+
+class OptionStoppingCriteria(transformers.StoppingCriteria):
+    """
+    Stops each sequence of a batch on its own, as soon as its continuation holds
+    an answer: one of the row's options (found the way `match_options` finds it,
+    as a substring) or the end of the answer list (`']` or `"]`). Finished
+    sequences are padded by `generate` until the whole batch is done.
+
+    An option that is the beginning of another option of the same row does not
+    stop the sequence, since the longer one may still be generated.
+    """
+
+    TERMINATORS = ("']", '"]')
+
+    def __init__(self, tokenizer, prompt_length, options):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.options = [
+            [option for option in row if isinstance(option, str)
+             and not any(other != option and str(other).startswith(option) for other in row)]
+            for row in options
+        ]
+        self.done = None
+
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+        # Only the sequences still running are decoded.
+        pending = (~self.done).nonzero().flatten().tolist()
+        texts = self.tokenizer.batch_decode(input_ids[pending, self.prompt_length:], skip_special_tokens=True)
+        for i, text in zip(pending, texts):
+            if any(end in text for end in self.TERMINATORS) or any(option in text for option in self.options[i]):
+                self.done[i] = True
+
+        return self.done.clone()
+
+
+
+def generate_batch(tokenizer, model, prompts, max_new_tokens=15, prefix_cache=None, options=None):
+    """
+    Generates the continuation of a batch of prompts.
+
+    With `options` (the options of each prompt), each sequence stops as soon as
+    it holds an answer (see `OptionStoppingCriteria`) instead of always running
+    for `max_new_tokens`.
+
+    Returns:
+        list of dict: for each prompt, the generated continuation only (the
+        prompt is not echoed back), the number of prompt and generated tokens
+        and the batch latency in milliseconds shared equally among its prompts
+    """
+    start = time.perf_counter()
+    input_ids, attention_mask, past_key_values = encode_prompts(tokenizer, model, prompts, prefix_cache)
+
+    stopping_criteria = None
+    if options is not None:
+        stopping_criteria = transformers.StoppingCriteriaList(
+            [OptionStoppingCriteria(tokenizer, input_ids.shape[1], options)])
+
+    with torch.no_grad():
+        output_ids = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.pad_token_id,
+            stopping_criteria=stopping_criteria,
+        )
+
+    new_tokens = output_ids[:, input_ids.shape[1]:]
+    continuations = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+    prompt_tokens = attention_mask.sum(dim=1).tolist()
+    generated_tokens = (new_tokens != tokenizer.pad_token_id).sum(dim=1).tolist()
+    latency_ms = (time.perf_counter() - start) * 1000 / len(prompts)
+
+    return [{'output': text, 'prompt_tokens': n_prompt, 'new_tokens': n_new, 'latency_ms': round(latency_ms, 2)}
+            for text, n_prompt, n_new in zip(continuations, prompt_tokens, generated_tokens)]
+
+
+
+def score_batch(tokenizer, model, prompts, options, prefix_cache=None):
+    """
+    Scores the three candidate options of each prompt instead of generating.
+
+    The prompts are encoded once; their key/value cache is then repeated for the
+    three options, which are scored as short continuations (written the way the
+    prompt asks for them, e.g. "['Sono pericolosi']") in one forward pass. The
+    option with the highest log-likelihood is returned as output.
+
+    Returns:
+        list of dict: for each prompt, the chosen option as a Python list string,
+        the probability of each option (softmax over the three log-likelihoods),
+        the number of prompt tokens and the batch latency per prompt
+    """
+    start = time.perf_counter()
+    n_options = len(options[0])
+
+    input_ids, prompt_mask, cache = encode_prompts(tokenizer, model, prompts, prefix_cache)
+    prompt_positions = (prompt_mask.cumsum(dim=1) - 1).clamp(min=0)
+    cached = cache.get_seq_length() if cache is not None else 0
+
+    answers = [f" {[option]}" for row in options for option in row]
+    answer_ids = tokenizer(answers, add_special_tokens=False, padding=True, padding_side="right",
+                           return_tensors="pt").to(model.device)
+    answer_mask = answer_ids["attention_mask"]
+
+    with torch.no_grad():
+        prompt_out = model(
+            input_ids=input_ids[:, cached:],
+            attention_mask=prompt_mask,
+            position_ids=prompt_positions[:, cached:],
+            past_key_values=cache,
+            use_cache=True,
+        )
+
+        cache = prompt_out.past_key_values
+        cache.batch_repeat_interleave(n_options)
+        attention_mask = torch.cat([prompt_mask.repeat_interleave(n_options, dim=0), answer_mask], dim=1)
+        prompt_lengths = prompt_mask.sum(dim=1).repeat_interleave(n_options)
+        positions = prompt_lengths[:, None] + torch.arange(answer_mask.shape[1], device=model.device)
+
+        answer_out = model(
+            input_ids=answer_ids["input_ids"],
+            attention_mask=attention_mask,
+            position_ids=positions,
+            past_key_values=cache,
+        )
+
+    # The first answer token is predicted by the last prompt position, every
+    # following one by the previous answer token.
+    logits = torch.cat([
+        prompt_out.logits[:, -1:].repeat_interleave(n_options, dim=0),
+        answer_out.logits[:, :-1],
+    ], dim=1).float()
+    log_probs = torch.log_softmax(logits, dim=-1)
+    token_log_probs = log_probs.gather(-1, answer_ids["input_ids"].unsqueeze(-1)).squeeze(-1)
+    scores = (token_log_probs * answer_mask).sum(dim=1).view(len(prompts), n_options)
+
+    probabilities = torch.softmax(scores, dim=1).tolist()
+    best = scores.argmax(dim=1).tolist()
+    prompt_tokens = prompt_mask.sum(dim=1).tolist()
+    latency_ms = (time.perf_counter() - start) * 1000 / len(prompts)
+
+    return [{'output': str([row_options[i]]), 'prompt_tokens': n_prompt, 'new_tokens': 0,
+             'latency_ms': round(latency_ms, 2),
+             **{f'p_option_{j + 1}': round(p, 6) for j, p in enumerate(row_probabilities)}}
+            for row_options, i, row_probabilities, n_prompt in zip(options, best, probabilities, prompt_tokens)]
+
+
+
+class Backend:
+    """
+    Produces the model outputs of `classify`.
+
+    Subclasses implement `generate` (free-text answers) and `score` (one answer
+    chosen among the options, with their probabilities); both receive a batch of
+    prompts and, for each prompt, one of the prediction rows it was built for
+    (id, span, labels and shuffled options), and return one dict per prompt with
+    at least `output` (plus any other prediction file column they fill).
+
+    Attributes:
+        name (str): Identifies the backend in cache keys, so outputs of different
+            backends are not mixed up
+    """
+
+    name = None
+
+    def load(self):
+        """Loads what is needed to answer; only called when there are rows to classify."""
+
+
+    def close(self):
+        """Called once all the prompts have been answered."""
 
-    for _,item in tqdm(dataset.iterrows(),total=len(dataset)):
-        output = pipeline(
-        item.prompt,
-        max_new_tokens=15,
-    )
 
+    def prompt_lengths(self, prompts):
+        """Length of each prompt, used to batch prompts of similar length together."""
+        return [len(prompt.split()) for prompt in prompts]
 
-    writer.writerow({'id':item.id,'span':item.chunk,'output':output,'05':item.cleaned_cl_ann05,'01':item.cleaned_cl_ann01,'02':item.cleaned_cl_ann02})
 
-    file.close()
\ No newline at end of file
+    def generate(self, prompts, rows, max_new_tokens=15):
+        raise NotImplementedError
+
+
+    def score(self, prompts, rows):
+        raise NotImplementedError
+
+
+
+def row_options(row):
+    return [row[col] for col in OPTION_COLUMNS]
+
+
+
+class HFBackend(Backend):
+    """A Hugging Face causal language model (Minerva by default)."""
+
+    def __init__(self, model_id="sapienzanlp/Minerva-7B-instruct-v1.0", seed=42, use_prefix_cache=True,
+                 precision="bf16", stop_on_answer=True):
+        # Outputs depend on the precision and on early stopping (a stopped output
+        # is cut short of what the full continuation holds): both are part of the
+        # name, and so of cache keys, except for the default precision.
+        self.name = model_id if precision == "bf16" else f"{model_id}:{precision}"
+        if stop_on_answer:
+            self.name += ":stop-on-answer"
+        self.model_id = model_id
+        self.seed = seed
+        self.use_prefix_cache = use_prefix_cache
+        self.precision = precision
+        self.stop_on_answer = stop_on_answer
+        self.tokenizer = None
+        self.model = None
+        self.prefix_cache = None
+
+
+    def load(self):
+        self.tokenizer, self.model = load_model(self.model_id, self.seed, self.precision)
+        if self.use_prefix_cache:
+            self.prefix_cache = PrefixCache(self.tokenizer, self.model, prompt_prefix())
+
+
+    def close(self):
+        if self.prefix_cache is not None and self.prefix_cache.misses:
+            print(f"Prompt tokenization did not preserve the instruction prefix in {self.prefix_cache.misses} "
+                  "batches, encoded without the prefix cache")
+
+
+    def prompt_lengths(self, prompts):
+        return [len(ids) for ids in self.tokenizer(prompts)["input_ids"]]
+
+
+    def generate(self, prompts, rows, max_new_tokens=15):
+        return generate_batch(self.tokenizer, self.model, prompts, max_new_tokens=max_new_tokens,
+                              prefix_cache=self.prefix_cache,
+                              options=[row_options(row) for row in rows] if self.stop_on_answer else None)
+
+
+    def score(self, prompts, rows):
+        return score_batch(self.tokenizer, self.model, prompts, [row_options(row) for row in rows],
+                           self.prefix_cache)
+
+
+
+class ReplayBackend(Backend):
+    """
+    Replays the outputs of existing classification files (compact or legacy).
+
+    Outputs are looked up by tweet id and options: first with the options in the
+    same order, then in any order (e.g. when replaying with other seeds). Prompts
+    with no recorded output get an empty one. The files are read when the backend
+    is created, so they can be the files `classify` is about to overwrite.
+    """
+
+    def __init__(self, paths):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.name = "replay:" + ",".join(sorted(os.path.abspath(path) for path in self.paths))
+        self.outputs = {}
+        self.misses = 0
+
+        for path in self.paths:
+            df = read_predictions(path, usecols=None)
+            for row in df[['id', 'output'] + OPTION_COLUMNS].to_dict('records'):
+                options = tuple(row_options(row))
+                self.outputs.setdefault((row['id'], options), row['output'])
+                self.outputs.setdefault((row['id'], tuple(sorted(map(str, options)))), row['output'])
+
+
+    def generate(self, prompts, rows, max_new_tokens=15):
+        generated = []
+        for row in rows:
+            options = tuple(row_options(row))
+            output = self.outputs.get((row['id'], options))
+            if output is None:
+                output = self.outputs.get((row['id'], tuple(sorted(map(str, options)))))
+            if output is None:
+                self.misses += 1
+                output = ""
+            generated.append({'output': output, 'new_tokens': 0})
+        return generated
+
+
+    def score(self, prompts, rows):
+        return self.generate(prompts, rows)
+
+
+    def close(self):
+        if self.misses:
+            print(f"No recorded output for {self.misses} prompts, replayed as empty outputs")
+
+
+
+class RandomBackend(Backend):
+    """
+    Deterministic stand-in for the model: each prompt gets one of its options,
+    chosen by a hash of the seed and the prompt, or for a `hallucination_rate`
+    share of prompts an answer matching none of them.
+    """
+
+    def __init__(self, seed=42, hallucination_rate=0.08):
+        self.name = f"random:{seed}:{hallucination_rate}"
+        self.seed = seed
+        self.hallucination_rate = hallucination_rate
+
+
+    def _draws(self, prompt, n):
+        digest = hashlib.md5(f"{self.seed}\n{prompt}".encode("utf-8")).digest()
+        return np.random.default_rng(int.from_bytes(digest[:8], "little")).random(n)
+
+
+    def generate(self, prompts, rows, max_new_tokens=15):
+        generated = []
+        for prompt, row in zip(prompts, rows):
+            options = row_options(row)
+            draw, choice = self._draws(prompt, 2)
+            if draw < self.hallucination_rate:
+                output = " ['Nessuna delle opzioni']"
+            else:
+                output = f" {[options[int(choice * len(options))]]}"
+            generated.append({'output': output, 'prompt_tokens': len(prompt.split()), 'new_tokens': len(output.split())})
+        return generated
+
+
+    def score(self, prompts, rows):
+        scored = []
+        for prompt, row in zip(prompts, rows):
+            options = row_options(row)
+            weights = self._draws(prompt, len(options))
+            probabilities = weights / weights.sum()
+            scored.append({'output': str([options[int(probabilities.argmax())]]),
+                           'prompt_tokens': len(prompt.split()), 'new_tokens': 0,
+                           **{f'p_option_{j + 1}': round(float(p), 6) for j, p in enumerate(probabilities)}})
+        return scored
+
+
+
+BACKENDS = {'hf': HFBackend, 'replay': ReplayBackend, 'random': RandomBackend}
+
+
+
+def prepare_dataset(df):
+    df = select(df, exclusion_spec(levels=[5], values=[UNCERTAIN], annotators=PROMPT_ANNOTATORS))
+
+    cleaned = {f"cleaned_cl_{ann}": df[cluster_column(5, ann)].map(LABEL_TEXT[ann]) for ann in PROMPT_ANNOTATORS}
+
+    df = df [['id', 'annotatore', 'tweet', 'chunk', 'annotazione','annotazioni_parsate']].assign(**cleaned)
+
+    return df
+
+
+
+def classify(df, pred_path, processed_fileame, prediction_filename, seed=42, batch_size=8,
+             model_id="sapienzanlp/Minerva-7B-instruct-v1.0", resume=False, mode="generate",
+             use_prefix_cache=True, cache_path=None, cache_max_bytes=None, max_new_tokens=15,
+             backend=None, precision="bf16", stop_on_answer=True, prompt_builder=build_prompts):
+    """
+    Classifies the filtered dataset with the LLM and writes one prediction file per run.
+
+    The outputs come from `backend` (see `Backend`): by default an `HFBackend`
+    with `model_id` loaded with `precision` (see `load_model`), stopping each
+    generation once it holds an answer unless `stop_on_answer` is False, or e.g.
+    a `ReplayBackend`/`RandomBackend` for fast offline runs.
+
+    `seed` can be a list of seeds: each one gives a different, per-row option
+    ordering (a run, see `build_prompts`), and all runs are produced with a single model load, with the
+    permutations of the same tweet batched together. In that case
+    `processed_fileame` and `prediction_filename` are lists with one name per seed.
+    `prompt_builder(dataset, seed)` returns the prompts of a run, in the format
+    of `build_prompts` (e.g. to reproduce the prompts of earlier runs).
+
+    With `cache_path`, outputs are looked up in an `InferenceCache` before calling
+    the model, and new outputs are added to it.
+    """
+    if mode not in ("generate", "score"):
+        raise ValueError("mode must be 'generate' (free-text generation) or 'score' (option log-likelihood)")
+
+    seeds = seed if isinstance(seed, (list, tuple)) else [seed]
+    processed_names = processed_fileame if isinstance(processed_fileame, (list, tuple)) else [processed_fileame]
+    prediction_names = prediction_filename if isinstance(prediction_filename, (list, tuple)) else [prediction_filename]
+    if not len(seeds) == len(processed_names) == len(prediction_names):
+        raise ValueError("One processed and one prediction filename are needed for each seed")
+
+    if backend is None:
+        backend = HFBackend(model_id, seeds[0], use_prefix_cache=use_prefix_cache, precision=precision,
+                            stop_on_answer=stop_on_answer)
+
+    dataset = prepare_dataset(df)
+    print(len(dataset))
+
+    cache = InferenceCache(cache_path, max_bytes=cache_max_bytes) if cache_path else None
+    generation_params = {'mode': mode, 'max_new_tokens': max_new_tokens}
+
+    writers = []
+    rows = []
+
+    for run, (run_seed, processed_name, prediction_name) in enumerate(zip(seeds, processed_names, prediction_names)):
+        writer = PredictionWriter(f'{pred_path}/{prediction_name}.csv', resume=resume)
+        writers.append(writer)
+
+        with stage("prompt_build", run=run + 1) as metrics:
+            run_prompts = prompt_builder(dataset, run_seed)
+            metrics["rows"] = len(run_prompts)
+        processed = pd.concat([dataset, run_prompts], axis=1)
+        processed.to_csv(f'{pred_path}/{processed_name}.csv',index=False)
+
+        run_rows = [{'id':item.id,'span':item.chunk,'05':item.cleaned_cl_ann05,'01':item.cleaned_cl_ann01,'02':item.cleaned_cl_ann02,
+                     'option_1':item.option_1,'option_2':item.option_2,'option_3':item.option_3,'prompt':item.prompt,
+                     'run':run,'group':position,'cache_key':InferenceCache.key(backend.name, item.prompt, run_seed, generation_params)}
+                    for position, item in enumerate(processed.itertuples(index=False))]
+        rows.extend(row for row in run_rows if prediction_key(row) not in writer.done)
+
+    if cache is not None and rows:
+        cached = cache.get_many({row['cache_key'] for row in rows})
+        for run, writer in enumerate(writers):
+            run_rows = [{**row, **cached[row['cache_key']]} for row in rows
+                        if row['run'] == run and row['cache_key'] in cached]
+            if run_rows:
+                writer.write_batch([{k: v for k, v in row.items() if k in writer.fieldnames} for row in run_rows])
+        rows = [row for row in rows if row['cache_key'] not in cached]
+        print("Outputs found in cache:", len(cached))
+
+    print("Rows to classify:", len(rows))
+
+    if not rows:
+        for writer in writers:
+            writer.close()
+        if cache is not None:
+            cache.close()
+        return
+
+    prompts = [row.pop('prompt') for row in rows]
+    runs = [row.pop('run') for row in rows]
+    groups = [row.pop('group') for row in rows]
+    cache_keys = [row.pop('cache_key') for row in rows]
+
+    # The same tweet with the same option order appears in several annotation rows:
+    # each distinct prompt is sent to the model once and its output fanned out.
+    members = {}
+    for i, prompt in enumerate(prompts):
+        members.setdefault(prompt, []).append(i)
+    unique_prompts = list(members)
+    print("Distinct prompts:", len(unique_prompts))
+
+    with stage("model_load", backend=backend.name):
+        backend.load()
+
+    lengths = backend.prompt_lengths(unique_prompts)
+    unique_groups = [groups[members[prompt][0]] for prompt in unique_prompts]
+
+    for batch in tqdm(length_buckets(lengths, batch_size, unique_groups if len(writers) > 1 else None)):
+        batch_prompts = [unique_prompts[u] for u in batch]
+        start = time.perf_counter()
+
+        first = [rows[members[prompt][0]] for prompt in batch_prompts]
+        if mode == "score":
+            generated = backend.score(batch_prompts, first)
+        else:
+            generated = backend.generate(batch_prompts, first, max_new_tokens=max_new_tokens)
+
+        seconds = time.perf_counter() - start
+        new_tokens = sum(output.get('new_tokens', 0) for output in generated)
+        emit("batch", mode=mode, prompts=len(batch_prompts), seconds=round(seconds, 4),
+             prompt_tokens=sum(output.get('prompt_tokens', 0) for output in generated), new_tokens=new_tokens,
+             tokens_per_second=round(new_tokens / seconds, 1) if seconds > 0 else None)
+
+        outputs = [(i, output) for prompt, output in zip(batch_prompts, generated) for i in members[prompt]]
+
+        if cache is not None:
+            cache.put_many({cache_keys[i]: output for i, output in outputs})
+
+        for run, writer in enumerate(writers):
+            run_rows = [{**rows[i], **output} for i, output in outputs if runs[i] == run]
+            if run_rows:
+                writer.write_batch(run_rows)
+
+    backend.close()
+    for writer in writers:
+        writer.close()
+    if cache is not None:
+        cache.close()
\ No newline at end of file
@@ -1,39 +1,136 @@
+import ast
+import numpy as np
 import pandas as pd
 import regex as re
 
+from src.instrumentation import stage
 
-def parse_single_file (input_file, output_file):
-    df = pd.read_csv(f'{input_file}')
 
+OPTION_COLUMNS = ['option_1', 'option_2', 'option_3']
 
-    df.output = df.output.apply(lambda x:x.split('Output')[-1])
-    df['pattern'] = df['05']+'|'+df['01']+'|'+df['02']
 
-
-    def parse_output(a,b):
+def extract_options(text):
+    match = re.search(r"Opzioni:\s*(\[[^\]]+\])", text)
+    if match:
+        raw_list_str = match.group(1)
+        # Replace escaped single quotes \' with normal single quotes '
+        cleaned_str = raw_list_str.replace("\\'", "'")
         try:
-            output = re.search(a,b).group()
-        except: output = None
+            # Safely parse the string list into a Python list
+            return ast.literal_eval(cleaned_str)
+        except Exception as e:
+            print(f"Error parsing list: {e}")
+            return None
+    return None
+
+
+def _prepare_predictions(df, options):
+    if 'output' not in df.columns:
+        return df
+
+    df['output'] = df['output'].fillna('').astype(str)
+
+    if options and not set(OPTION_COLUMNS).issubset(df.columns):
+        options = df['output'].apply(extract_options)
+        for i, col in enumerate(OPTION_COLUMNS):
+            df[col] = options.apply(lambda x: x[i] if isinstance(x, list) and len(x) > i else None)
+
+    df['output'] = df['output'].str.rsplit('Output', n=1).str[-1]
+
+    return df
+
+
+def read_predictions(input_file, options=True, chunksize=None, usecols=None):
+    """
+    Reads a classification file written by `classify`, in either layout:
+
+    - compact: `output` holds the generated continuation only and the shuffled
+      options are stored in `option_1`, `option_2`, `option_3`
+    - legacy: `output` holds the text-generation pipeline output, with the whole
+      prompt echoed back; options are recovered from the prompt
+
+    In both cases `output` is returned as the text after the last 'Output'
+    marker. With `options=True` the option columns are filled for legacy files
+    too, which requires scanning the echoed prompts.
+
+    With `chunksize`, an iterator over dataframes of at most `chunksize` rows is
+    returned instead, so that large files can be processed with bounded memory.
+    """
+    if chunksize is None:
+        return _prepare_predictions(pd.read_csv(f'{input_file}', usecols=usecols), options)
+
+    return (_prepare_predictions(chunk, options)
+            for chunk in pd.read_csv(f'{input_file}', chunksize=chunksize, usecols=usecols))
+
+
+ANNOTATOR_COLUMNS = ['05', '01', '02']
+
+
+def match_options(output, options):
+    """
+    Finds which of the row's options occurs first in the model output.
+
+    Equivalent to searching each output with the alternation `05|01|02` of its own
+    options (leftmost match, ties going to the first alternative), but computed
+    column-wise: for each annotator column, the rows are grouped by option phrase
+    (a handful of known labels) and located with one vectorized `str.find` each.
+
+    Returns:
+        tuple of pandas.Series: the matched option (None when no option occurs, or
+        when an option is missing) and the label of the annotator it belongs to
+    """
+    positions = np.full((len(output), len(options.columns)), -1, dtype=np.int64)
+
+    for j, col in enumerate(options.columns):
+        for phrase, index in options.groupby(col, sort=False).indices.items():
+            positions[index, j] = output.iloc[index].str.find(phrase).to_numpy()
+
+    found = positions >= 0
+    first = np.where(found, positions, np.iinfo(np.int64).max).argmin(axis=1)
+    matched = found.any(axis=1) & options.notna().all(axis=1).to_numpy()
+
+    values = options.to_numpy(dtype=object)[np.arange(len(output)), first]
+    parsed = pd.Series(np.where(matched, values, None), index=output.index, dtype=object)
+    labels = pd.Series(np.array([f'ann{col}' for col in options.columns], dtype=object)[first], index=output.index)
 
-        return output
+    return parsed, labels
 
-    df['parsed_output'] = df.apply(lambda x:parse_output(x.pattern,x.output),axis=1)
-    df = df.dropna().drop_duplicates(subset=['id','05','01','02'])
 
-    l = list()
+def parse_single_file (input_file, output_file, chunksize=None):
+    """
+    Parses a classification file and writes, for each (id, 05, 01, 02), the first
+    output where one of the options was found, with its annotator label.
 
-    for _,item in df.iterrows():
-        if item.parsed_output==item['05']:
-            l.append('ann05')
-        elif item.parsed_output==item['01']:
-            l.append('ann01')
-        else:
-            l.append('ann02')
+    With `chunksize`, the file is read and parsed `chunksize` rows at a time and
+    appended to `output_file`; duplicates are suppressed with a set of the keys
+    already written, so memory does not grow with the generated text.
+    """
+    key_cols = ['id','05','01','02']
+    seen = set()
+    header = True
 
-    df['label'] = l
-    df.to_csv(f'{output_file}',index=False)
+    with stage("parse", input_file=input_file) as metrics:
+        chunks = read_predictions(input_file, options=False, chunksize=chunksize,
+                                  usecols=['id','span','output','05','01','02'])
+        if chunksize is None:
+            chunks = [chunks]
 
+        metrics['rows'] = metrics['parsed'] = 0
+        for df in chunks:
+            metrics['rows'] += len(df)
+            df = df[['id','span','output','05','01','02']]
 
+            df['pattern'] = df['05']+'|'+df['01']+'|'+df['02']
 
+            df['parsed_output'], labels = match_options(df['output'], df[ANNOTATOR_COLUMNS])
+            df['label'] = labels
+            df = df.dropna().drop_duplicates(subset=key_cols)
 
+            keys = pd.MultiIndex.from_frame(df[key_cols].astype(str))
+            new = ~keys.isin(seen) if seen else np.ones(len(df), dtype=bool)
+            df = df[new]
+            seen.update(keys[new])
+            metrics['parsed'] += len(df)
 
+            df.to_csv(f'{output_file}', index=False, mode='w' if header else 'a', header=header)
+            header = False
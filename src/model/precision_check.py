@@ -0,0 +1,174 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from src.instrumentation import memory
+from src.model.classification import (PROMPT_ANNOTATORS, QUANTIZED_MODEL_FILE, HFBackend, build_prompts, classify,
+                                      format_prompt)
+from src.model.parse_output import OPTION_COLUMNS, parse_single_file, read_predictions
+
+
+KEY_COLUMNS = ['id', '05', '01', '02']
+
+
+
+def compare_parsed(reference, candidate):
+    """
+    Agreement of a parsed output file with a reference one (e.g. a committed
+    parsed_output_<i>.csv), on the items of the reference.
+
+    Returns:
+        dict: number of items, share of them parsed in the candidate, and share
+        for which the candidate picked the same annotator's option
+    """
+    columns = KEY_COLUMNS + ['label']
+    merged = reference[columns].merge(candidate[columns], on=KEY_COLUMNS, how='left',
+                                      suffixes=('_reference', '_candidate'))
+    return {
+        'items': len(merged),
+        'parsed': merged['label_candidate'].notna().mean(),
+        'same_label': (merged['label_reference'] == merged['label_candidate']).mean(),
+    }
+
+
+
+def sample_ids(ids, sample, seed=0):
+    ids = np.sort(pd.unique(ids))
+    if sample is None or sample >= len(ids):
+        return ids
+    return np.random.default_rng(seed).choice(ids, size=sample, replace=False)
+
+
+
+def reference_prompts(dataset, classification_file):
+    """
+    Prompts of `dataset` with the option order of each row in an existing
+    classification file (e.g. a committed classifications_<i>.csv, whose prompts
+    were built by `create_prompt`), in the format of `build_prompts`. Rows absent
+    from the file get the order of `build_prompts`.
+    """
+    reference = read_predictions(classification_file, usecols=None)
+    reference = reference[KEY_COLUMNS + OPTION_COLUMNS].drop_duplicates(KEY_COLUMNS)
+    reference['id'] = reference['id'].astype(str)
+
+    keys = dataset[['id'] + [f'cleaned_cl_{ann}' for ann in PROMPT_ANNOTATORS]].astype(object)
+    keys.columns = KEY_COLUMNS
+    keys['id'] = keys['id'].astype(str)
+    options = keys.merge(reference, on=KEY_COLUMNS, how='left')[OPTION_COLUMNS].to_numpy(dtype=object)
+
+    prompts = build_prompts(dataset, 0)
+    found = pd.notna(options).all(axis=1)
+    labels = keys[['05', '01', '02']].to_numpy(dtype=object)
+    for j, col in enumerate(OPTION_COLUMNS):
+        prompts.loc[found, col] = options[found, j]
+    for k, ann in enumerate(PROMPT_ANNOTATORS):
+        positions = np.argmax(options == labels[:, [k]], axis=1) + 1
+        prompts.loc[found, f'pos_{ann[3:]}'] = positions[found]
+    prompts.loc[found, 'prompt'] = [format_prompt(tweet, list(row_options))
+                                    for tweet, row_options in zip(dataset['tweet'][found], options[found])]
+    return prompts
+
+
+
+def classify_with_precision(df, output_dir, seeds, precision, model_id, use_prefix_cache, **classify_kwargs):
+    """Classifies `df` once per seed with the model loaded in `precision`, and parses the outputs."""
+    names = [f"{precision}_{i}" for i in range(1, len(seeds) + 1)]
+
+    start = time.perf_counter()
+    classify(
+        df=df,
+        pred_path=output_dir,
+        processed_fileame=[f"processed_{name}" for name in names],
+        prediction_filename=[f"classifications_{name}" for name in names],
+        seed=seeds,
+        backend=HFBackend(model_id, seeds[0], use_prefix_cache=use_prefix_cache, precision=precision),
+        **classify_kwargs
+    )
+    seconds = time.perf_counter() - start
+
+    parsed_paths = []
+    for name in names:
+        parsed_paths.append(f"{output_dir}/parsed_{name}.csv")
+        parse_single_file(f"{output_dir}/classifications_{name}.csv", parsed_paths[-1])
+
+    return names, parsed_paths, seconds
+
+
+
+def read_parsed(path, ids=None):
+    parsed = pd.read_csv(path, dtype={col: str for col in KEY_COLUMNS})
+    return parsed if ids is None else parsed[parsed['id'].isin(ids)]
+
+
+
+def check_precision(df, reference_files, reference_classifications, output_dir, seeds=(42,), precision="int8",
+                    reference_precision=None, model_id="sapienzanlp/Minerva-7B-instruct-v1.0", sample=None,
+                    use_prefix_cache=True, **classify_kwargs):
+    """
+    Classifies (a sample of the tweets of) `df` with the model loaded in
+    `precision`, with the prompts of earlier runs, and compares the parsed
+    outputs with the labels of those runs.
+
+    The option order of each prompt is taken from `reference_classifications`
+    (see `reference_prompts`), so that the agreement measures the effect of the
+    precision, not of the option order. With `reference_precision`, the same
+    prompts are also classified with the model loaded in that precision, and the
+    outputs are compared with those too (at the cost of a second model run).
+
+    Parameters:
+    -----------
+    reference_files : list
+        - parsed output of each earlier run (one per seed of `seeds`)
+    reference_classifications : list
+        - classification file of each earlier run, whose prompts are reused
+    output_dir : str
+        - where the classification and parsed files of the check are written
+    sample : int
+        - number of tweets to classify, None for all
+
+    Returns:
+    --------
+    pd.DataFrame: one row per run and reference with the agreement (see
+    `compare_parsed`), the classification time and the peak resident memory of
+    the `precision` run
+    """
+    seeds = list(seeds)
+    if not len(reference_files) == len(reference_classifications) == len(seeds):
+        raise ValueError("One reference file and one reference classification file are needed for each seed")
+    if len(set(seeds)) != len(seeds):
+        raise ValueError("Seeds must be distinct")
+    if precision == reference_precision:
+        raise ValueError("precision and reference_precision must differ")
+    if reference_precision and os.path.isfile(os.path.join(model_id, QUANTIZED_MODEL_FILE)):
+        raise ValueError("A quantized model is loaded as int8 whatever the precision: check with the original model")
+
+    df = df[df['id'].isin(sample_ids(df['id'], sample))]
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Each run reuses the prompts of the earlier run it is compared with.
+    reference_of_seed = dict(zip(seeds, reference_classifications))
+    classify_kwargs['prompt_builder'] = lambda dataset, seed: reference_prompts(dataset, reference_of_seed[seed])
+
+    # The checked precision runs first, so that the peak memory is its own.
+    names, candidate_paths, seconds = classify_with_precision(
+        df, output_dir, seeds, precision, model_id, use_prefix_cache, **classify_kwargs)
+    usage = memory()
+
+    references = [reference_files]
+    timings = {'classify_seconds': round(seconds, 1)}
+    if reference_precision:
+        _, reference_paths, reference_seconds = classify_with_precision(
+            df, output_dir, seeds, reference_precision, model_id, use_prefix_cache, **classify_kwargs)
+        references.append(reference_paths)
+        timings['reference_seconds'] = round(reference_seconds, 1)
+
+    results = []
+    for reference_paths in references:
+        for name, seed, candidate_path, reference_path in zip(names, seeds, candidate_paths, reference_paths):
+            results.append({'run': name, 'seed': seed, 'reference': reference_path,
+                            **compare_parsed(read_parsed(reference_path, df['id']), read_parsed(candidate_path))})
+
+    results = pd.DataFrame(results).assign(**timings, **usage)
+    print(results.to_string(index=False))
+    return results
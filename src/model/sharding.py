@@ -0,0 +1,104 @@
+import os
+import hashlib
+import multiprocessing
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from src.model.classification import classify
+
+
+
+def shard_of(ids, n_shards):
+    """
+    Assigns each id to a shard with a stable hash, so that every process (on any
+    machine) computes the same split, and all annotations of a tweet stay together.
+    """
+    return ids.astype(str).map(lambda x: int(hashlib.md5(x.encode("utf-8")).hexdigest(), 16) % n_shards)
+
+
+
+def shard_name(name, shard_index, n_shards):
+    return f"{name}.shard{shard_index:03d}-of-{n_shards:03d}"
+
+
+
+def _as_list(names):
+    return list(names) if isinstance(names, (list, tuple)) else [names]
+
+
+
+def classify_shard(df, pred_path, processed_fileame, prediction_filename, n_shards, shard_index, **kwargs):
+    """
+    Classifies only the rows of `df` falling in shard `shard_index` out of `n_shards`.
+    Output files get a `.shardXXX-of-YYY` suffix and are combined by `merge_shards`.
+    """
+    df_shard = df[shard_of(df["id"], n_shards) == shard_index]
+
+    classify(
+        df=df_shard,
+        pred_path=pred_path,
+        processed_fileame=[shard_name(name, shard_index, n_shards) for name in _as_list(processed_fileame)],
+        prediction_filename=[shard_name(name, shard_index, n_shards) for name in _as_list(prediction_filename)],
+        **kwargs
+    )
+
+
+
+def _init_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+
+
+
+def _run_shard(args):
+    df, kwargs = args
+    classify_shard(df, **kwargs)
+    return kwargs["shard_index"]
+
+
+
+def merge_shards(pred_path, processed_fileame, prediction_filename, n_shards):
+    """
+    Combines shard files into the usual `<name>.csv` layout. Rows are concatenated
+    in shard order and then stably sorted on (id, 05, 01, 02), so the result does
+    not depend on which worker or machine finished first.
+    """
+    for names, key in ((_as_list(processed_fileame), ['id', 'cleaned_cl_ann05', 'cleaned_cl_ann01', 'cleaned_cl_ann02']),
+                       (_as_list(prediction_filename), ['id', '05', '01', '02'])):
+        for name in names:
+            paths = [f"{pred_path}/{shard_name(name, i, n_shards)}.csv" for i in range(n_shards)]
+            missing = [path for path in paths if not os.path.exists(path)]
+            if missing:
+                raise FileNotFoundError(f"Missing shard files: {missing}")
+
+            merged = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+            merged = merged.sort_values(key, kind="stable")
+            merged.to_csv(f"{pred_path}/{name}.csv", index=False)
+            print(f"Merged {n_shards} shards into {pred_path}/{name}.csv", merged.shape)
+
+
+
+def classify_sharded(df, pred_path, processed_fileame, prediction_filename, n_shards, workers=None,
+                     threads_per_worker=None, **kwargs):
+    """
+    Runs `classify` on `n_shards` shards in a pool of worker processes, each with
+    its own model copy and a pinned number of torch threads, then merges the outputs.
+    """
+    workers = workers or n_shards
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+
+    # Inherited by the spawned workers before they import torch.
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)
+    os.environ["MKL_NUM_THREADS"] = str(threads_per_worker)
+
+    shards = shard_of(df["id"], n_shards)
+    tasks = [(df[shards == i], {**kwargs, 'pred_path': pred_path, 'processed_fileame': processed_fileame,
+                   'prediction_filename': prediction_filename, 'n_shards': n_shards, 'shard_index': i})
+             for i in range(n_shards)]
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+        for shard_index in pool.map(_run_shard, tasks):
+            print(f"Shard {shard_index + 1}/{n_shards} done")
+
+    merge_shards(pred_path, processed_fileame, prediction_filename, n_shards)
@@ -0,0 +1,124 @@
+import os
+import csv
+import json
+import time
+
+
+
+def prediction_key(row):
+    return (str(row['id']), str(row['05']), str(row['01']), str(row['02']))
+
+
+
+class PredictionWriter:
+    """
+    Streams predictions to the classification csv one batch at a time.
+
+    After every batch the csv is flushed and a line is appended to a checkpoint
+    file (`<csv>.ckpt`) with the completed (id, 05, 01, 02) keys and the csv size
+    at that point. On resume, the csv is truncated back to the last checkpointed
+    size it reaches, so a batch interrupted halfway is simply recomputed.
+
+    Flushed batches survive the process being killed; both files are also synced
+    to disk (fsync, which survives a system crash) at most every `sync_interval`
+    seconds, and when the writer is closed.
+
+    Attributes:
+        path (str): Path of the classification csv
+        checkpoint_path (str): Path of the checkpoint file
+        done (set): Keys of the rows already classified
+    """
+
+    fieldnames = ['id','span','output',"05","01","02",
+                  'option_1','option_2','option_3','prompt_tokens','new_tokens','latency_ms',
+                  'p_option_1','p_option_2','p_option_3']
+
+    def __init__(self, path, resume=False, sync_interval=5.0):
+        self.path = path
+        self.checkpoint_path = f"{path}.ckpt"
+        self.sync_interval = sync_interval
+        self.last_sync = time.monotonic()
+        self.done = set()
+
+        offset = self._load_checkpoint() if resume else None
+
+        if offset is None:
+            self.done = set()
+            self.file = open(self.path, mode='w')
+            self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames)
+            self.writer.writeheader()
+            self.file.flush()
+            self.checkpoint = open(self.checkpoint_path, mode='w')
+            self._write_checkpoint([])
+        else:
+            with open(self.path, mode='r+b') as f:
+                f.truncate(offset)
+            with open(self.checkpoint_path, mode='r+b') as f:
+                f.truncate(self.checkpoint_size)
+            self.file = open(self.path, mode='a')
+            self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames)
+            self.checkpoint = open(self.checkpoint_path, mode='a')
+            print(f"Resuming {self.path}: {len(self.done)} rows already classified")
+
+
+    def _load_checkpoint(self):
+        if not (os.path.exists(self.path) and os.path.exists(self.checkpoint_path)):
+            return None
+
+        # After a system crash, checkpoint lines may refer to csv content that
+        # never reached the disk: those batches are redone too.
+        # Lines after the last valid one are dropped when resuming.
+        size = os.path.getsize(self.path)
+        offset = None
+        self.checkpoint_size = 0
+        with open(self.checkpoint_path, mode='rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partially written last line: the batch it refers to is redone.
+                    break
+                if not line.endswith(b"\n") or entry['offset'] > size:
+                    break
+                offset = entry['offset']
+                self.checkpoint_size += len(line)
+                self.done.update(tuple(key) for key in entry['keys'])
+
+        return offset
+
+
+    @staticmethod
+    def _sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+
+    def _write_checkpoint(self, keys):
+        entry = {'offset': os.fstat(self.file.fileno()).st_size, 'keys': [list(key) for key in keys]}
+        self.checkpoint.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.checkpoint.flush()
+
+
+    def _sync_files(self):
+        # The csv first, so that a synced checkpoint never refers to unsynced rows.
+        self._sync(self.file)
+        self._sync(self.checkpoint)
+        self.last_sync = time.monotonic()
+
+
+    def write_batch(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+        keys = [prediction_key(row) for row in rows]
+        self._write_checkpoint(keys)
+        self.done.update(keys)
+
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self._sync_files()
+
+
+    def close(self):
+        self._sync_files()
+        self.file.close()
+        self.checkpoint.close()
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("accelerate")
+pytest.importorskip("safetensors")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.model.classification import (QUANTIZED_MODEL_FILE, load_quantized_model, quantize_linear_layers,
+                                      save_quantized_model)
+
+
+def tiny_model(tie_word_embeddings):
+    config = transformers.LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=4,
+                                      tie_word_embeddings=tie_word_embeddings)
+    torch.manual_seed(0)
+    return transformers.LlamaForCausalLM(config).eval()
+
+
+@pytest.mark.parametrize("tie_word_embeddings", [False, True])
+def test_save_and_reload_quantized_model(tmp_path, tie_word_embeddings):
+    model = quantize_linear_layers(tiny_model(tie_word_embeddings))
+    save_quantized_model(model, tmp_path)
+
+    assert sorted(os.listdir(tmp_path)) == sorted(["config.json", QUANTIZED_MODEL_FILE])
+
+    reloaded = load_quantized_model(tmp_path).eval()
+    assert not any(t.is_meta for t in list(reloaded.parameters()) + list(reloaded.buffers()))
+    assert isinstance(reloaded.lm_head, torch.ao.nn.quantized.dynamic.Linear)
+
+    input_ids = torch.tensor([[1, 5, 17, 42, 99, 3]])
+    with torch.no_grad():
+        assert torch.equal(model(input_ids).logits, reloaded(input_ids).logits)